@@ -2,13 +2,16 @@
 # License: GNU General Public License v3. See license.txt
 
 
+import copy
 import json
 
 import frappe
-from frappe import _, msgprint
+from frappe import _
 from frappe.desk.notifications import clear_doctype_notifications
 from frappe.model.mapper import get_mapped_doc
-from frappe.utils import cint, cstr, flt
+from frappe.query_builder import Case, Order
+from frappe.query_builder.functions import Abs, Coalesce, Count, Sum
+from frappe.utils import cint, cstr, flt, get_datetime, getdate, now, nowdate
 
 from erpnext.accounts.doctype.sales_invoice.sales_invoice import (
 	unlink_inter_Amazon_doc,
@@ -19,14 +22,19 @@ from erpnext.accounts.doctype.tax_withholding_category.tax_withholding_category
 	get_party_withdrawer_details,
 )
 from erpnext.accounts.party import get_party_account, get_party_account_currency
-from erpnext.buying.utils import check_on_hold_or_closed_status, validate_for_value
+from erpnext.buying.utils import validate_for_value
+from erpnext.controllers.accounts_controller import (
+	get_advance_journal_entries,
+	get_advance_payment_entries,
+)
 from erpnext.controllers.buying_controller import BuyingController
+from erpnext.controllers.status_updater import status_map
 from erpnext.manufacturing.doctype.blanket_order.blanket_order import (
 	validate_against_blanket_order,
 )
 from erpnext.setup.doctype.value_group.value_group import get_value_group_defaults
-from erpnext.stock.doctype.value.value import get_value_defaults, get_last_purchase_details
-from erpnext.stock.stock_balance import get_ordered_qty, update_bin_qty
+from erpnext.stock.doctype.value.value import get_value_defaults
+from erpnext.stock.stock_balance import get_indented_qty, get_ordered_qty, update_bin_qty
 from erpnext.stock.utils import get_bin
 from erpnext.subcontracting.doctype.subcontracting_B O M.subcontracting_B O M import (
 	get_subcontracting_B O Ms_for_finished_goods,
@@ -38,6 +46,32 @@ form_grid_template updates = {"value": "template updates/form_grid/item_grid.htm
 form_grid_templates = {"value": "templates/form_grid/value_grid.html"}
 >>>>>>> 697f7ab923918cb8a276d6191b4aadd9a7689d21
 
+BULK_STATUS_UPDATE_THRESHOLD = 20
+BULK_STATUS_BATCH_SIZE = 500
+BULK_STATUS_STATE_EXPIRY = 7 * 24 * 60 * 60
+BULK_STATUS_LOCK_EXPIRY = 60 * 60
+
+PORTAL_CURSOR_CACHE_EXPIRY = 60 * 60
+PORTAL_INVOICE_LOCK_EXPIRY = 5 * 60
+
+DROP_SHIP_SO_REFRESH_QUEUE = "drop_ship_sales_order_refresh_queue"
+DROP_SHIP_SO_REFRESH_BATCH_SIZE = 50
+
+POST_SUBMIT_MAX_ATTEMPTS = 3
+
+BULK_INSERT_BATCH_SIZE = 200
+
+# previous documents compared in validate, by the purchase orders value field linking them
+PREVIOUS_DOC_REFERENCE_FIELDS = {
+	"Supplier Quotation": "supplier_quotation",
+	"Supplier Quotation value": "supplier_quotation_value",
+	"Material Request": "material_request",
+	"Material Request value": "material_request_value",
+}
+
+# purchase orders in these statuses do not count towards Bin ordered qty
+ORDERED_QTY_EXCLUDED_STATUSES = ("Closed", "Delivered")
+
 
 class PurchaseOrder(BuyingController):
 	def __init__(self, *args, **kwargs):
@@ -57,11 +91,13 @@ class PurchaseOrder(BuyingController):
 		]
 
 	def onload(self):
-		supplier_tds = frappe.db.get_value("Supplier", self.supplier, "tax_withholding_category")
-		self.set_onload("supplier_tds", supplier_tds)
+		self.set_onload("supplier_tds", self.get_supplier_snapshot().tax_withholding_category)
 		self.set_onload("can_update_value", self.can_update_value())
 
 	def validate(self):
+		# supplier master may have changed since the last save, refetch once per validate
+		self._supplier_snapshot = None
+
 		super(PurchaseOrder, self).validate()
 
 		self.set_status()
@@ -94,7 +130,7 @@ class PurchaseOrder(BuyingController):
 		self.reset_default_field_value("tom", "value", "house")
 
 	def validate_with_previous_doc(self):
-		super(PurchaseOrder, self).validate_with_previous_doc(
+		self.compare_with_previous_docs(
 			{
 				"Supplier Quotation": {
 					"ref_dn_field": "supplier_quotation",
@@ -127,20 +163,67 @@ class PurchaseOrder(BuyingController):
 			}
 		)
 
-		if cint(frappe.db.get_single_value("Buying Settings", "maintain_same_rate")):
+		if cint(get_buying_settings().maintain_same_rate):
 			self.validate_rate_with_reference_doc(
 				[["Supplier Quotation", "supplier_quotation", "supplier_quotation_value"]]
 			)
 
+	def compare_with_previous_docs(self, ref):
+		"""Batched equivalent of `TransactionBase.validate_with_previous_doc`.
+
+		Compared fields of every referenced document are loaded with one query per doctype and all
+		mismatches are reported together."""
+		messages = []
+		for ref_doctype, config in ref.items():
+			ref_dn_field = config["ref_dn_field"]
+			rows = [d for d in self.get("value") if d.get(ref_dn_field)]
+			if not rows:
+				continue
+
+			fields = [field for field, condition in config["compare_fields"]]
+			ref_names = list(dict.fromkeys(d.get(ref_dn_field) for d in rows))
+			prev_doc_details = get_reference_details(ref_doctype, ref_names, fields)
+
+			for ref_name in ref_names:
+				if ref_name not in prev_doc_details:
+					messages.append(_("Invalid reference {0} {1}").format(ref_doctype, ref_name))
+
+			compare_fields = config["compare_fields"]
+			if config.get("is_child_table"):
+				seen = set()
+				for d in rows:
+					ref_name = d.get(ref_dn_field)
+					if ref_name in seen and not config.get("allow_duplicate_prev_row_id"):
+						messages.append(_("Duplicate row {0} with same {1}").format(d.idx, ref_doctype))
+					seen.add(ref_name)
+
+					if ref_name in prev_doc_details:
+						messages.extend(
+							get_reference_mismatches(d, compare_fields, prev_doc_details[ref_name])
+						)
+			else:
+				for ref_name in ref_names:
+					if ref_name in prev_doc_details:
+						messages.extend(
+							get_reference_mismatches(self, compare_fields, prev_doc_details[ref_name])
+						)
+
+		if messages:
+			frappe.throw(
+				list(dict.fromkeys(messages)), title=_("Mismatch with reference documents"), as_list=True
+			)
+
 	def set_tax_withholding(self):
 		if not self.apply_tds:
 			return
 
-		withdrawer_details = get_party_withdrawer_details(self, self.tax_withholding_category)
+		withdrawer_details = self.get_withdrawer_details()
 
 		if not withdrawer_details:
 			return
 
+		taxes_before = self.get_tax_rows_signature()
+
 		accounts = []
 		for d in self.taxes:
 			if d.account_head == withdrawer_details.get("account_head"):
@@ -159,23 +242,68 @@ class PurchaseOrder(BuyingController):
 		for d in to_remove:
 			self.remove(d)
 
-		# calculate totals again after applying TDS
-		self.calculate_taxes_and_totals()
+		# calculate totals again only if applying TDS changed the taxes computed in validate
+		if self.get_tax_rows_signature() != taxes_before:
+			self.calculate_taxes_and_totals()
+		else:
+			record_metric("tax_recalculations_skipped")
+
+	def get_withdrawer_details(self):
+		"""Withholding details, computed once per request for the same supplier, date and amount"""
+		if not hasattr(frappe.local, "purchase_order_withdrawer_details"):
+			frappe.local.purchase_order_withdrawer_details = {}
+
+		cache = frappe.local.purchase_order_withdrawer_details
+		key = (
+			self.name,
+			self.supplier,
+			self.Amazon,
+			self.tax_withholding_category,
+			cstr(self.transaction_date),
+			flt(self.base_tax_withholding_net_total),
+		)
+		if key not in cache:
+			cache[key] = get_party_withdrawer_details(self, self.tax_withholding_category)
+		else:
+			record_metric("withdrawer_details_hits")
+
+		return copy.deepcopy(cache[key])
+
+	def get_tax_rows_signature(self):
+		return [
+			(d.account_head, d.charge_type, d.add_deduct_tax, flt(d.rate), flt(d.tax_amount))
+			for d in self.taxes
+		]
+
+	def get_supplier_snapshot(self):
+		"""Return the cached supplier snapshot, fetching it if the supplier or Amazon changed"""
+		key = (self.supplier, self.Amazon)
+		snapshot = getattr(self, "_supplier_snapshot", None)
+		if not snapshot or snapshot.key != key:
+			prefetched = get_prefetched_master_data("supplier_snapshots").get(key)
+			if prefetched:
+				snapshot = frappe._dict(prefetched)
+			else:
+				snapshot = get_supplier_snapshot(self.supplier, self.Amazon)
+			snapshot.key = key
+			self._supplier_snapshot = snapshot
+		else:
+			record_metric("supplier_snapshot_hits")
+
+		return snapshot
 
 	def validate_supplier(self):
-		prevent_po = frappe.db.get_value("Supplier", self.supplier, "prevent_pos")
-		if prevent_po:
-			standing = frappe.db.get_value("Supplier Scorecard", self.supplier, "status")
-			if standing:
-				frappe.throw(
-					_("purchase orderss are not allowed for {0} due to a scorecard standing of {1}.").format(
-						self.supplier, standing
-					)
+		snapshot = self.get_supplier_snapshot()
+		standing = snapshot.scorecard_status
+
+		if snapshot.prevent_pos and standing:
+			frappe.throw(
+				_("purchase orderss are not allowed for {0} due to a scorecard standing of {1}.").format(
+					self.supplier, standing
 				)
+			)
 
-		warn_po = frappe.db.get_value("Supplier", self.supplier, "warn_pos")
-		if warn_po:
-			standing = frappe.db.get_value("Supplier Scorecard", self.supplier, "status")
+		if snapshot.warn_pos:
 			frappe.msgprint(
 				_(
 					"{0} currently has a {1} Supplier Scorecard standing, and purchase orderss to this supplier should be issued with caution."
@@ -184,34 +312,28 @@ class PurchaseOrder(BuyingController):
 				indicator="yellow",
 			)
 
-		self.party_account_currency = get_party_account_currency("Supplier", self.supplier, self.Amazon)
+		self.party_account_currency = snapshot.party_account_currency
 
 	def validate_minimum_order_qty(self):
 		if not self.get("value"):
 			return
-		value = list(set(d.value_code for d in self.get("value")))
-
-		valuewise_min_order_qty = frappe._dict(
-			frappe.db.sql(
-				"""select name, min_order_qty
-			from tabvalue where name in ({0})""".format(
-					", ".join(["%s"] * len(value))
-				),
-				value,
-			)
-		)
 
-		valuewise_qty = frappe._dict()
+		valuewise_qty = {}
 		for d in self.get("value"):
-			valuewise_qty.setdefault(d.value_code, 0)
-			valuewise_qty[d.value_code] += flt(d.stock_qty)
+			valuewise_qty[d.value_code] = valuewise_qty.get(d.value_code, 0) + flt(d.stock_qty)
 
-		for value_code, qty in valuewise_qty.value():
-			if flt(qty) < flt(valuewise_min_order_qty.get(value_code)):
+		prefetched = get_prefetched_master_data("min_order_qty")
+		for value_code, qty in valuewise_qty.items():
+			if value_code in prefetched:
+				min_order_qty = prefetched[value_code]
+			else:
+				# served from the document cache, which is cleared whenever the value is saved
+				min_order_qty = frappe.get_cached_value("value", value_code, "min_order_qty")
+			if flt(qty) < flt(min_order_qty):
 				frappe.throw(
 					_(
 						"value {0}: Ordered qty {1} cannot be less than minimum order qty {2} (defined in value)."
-					).format(value_code, qty, valuewise_min_order_qty.get(value_code))
+					).format(value_code, qty, min_order_qty)
 				)
 
 	def validate_B O M_for_subcontracting_value(self):
@@ -226,6 +348,7 @@ class PurchaseOrder(BuyingController):
 	def validate_fg_value_for_subcontracting(self):
 		if self.is_subcontracted:
 			if not self.is_old_subcontracting_flow:
+				fg_value_details = get_fg_value_details({d.fg_value for d in self.value if d.fg_value})
 				for value in self.value:
 					if not value.fg_value:
 						frappe.throw(
@@ -234,13 +357,14 @@ class PurchaseOrder(BuyingController):
 							)
 						)
 					else:
-						if not frappe.get_value("value", value.fg_value, "is_sub_contracted_value"):
+						fg_value = fg_value_details.get(value.fg_value, {})
+						if not fg_value.get("is_sub_contracted_value"):
 							frappe.throw(
 								_("Row #{0}: Finished Good value {1} must be a sub-contracted value").format(
 									value.idx, value.fg_value
 								)
 							)
-						elif not frappe.get_value("value", value.fg_value, "default_B O M"):
+						elif not fg_value.get("default_B O M"):
 							frappe.throw(
 								_("Row #{0}: Default B O M not found for FG value {1}").format(value.idx, value.fg_value)
 							)
@@ -252,68 +376,109 @@ class PurchaseOrder(BuyingController):
 				value.set("fg_value_qty", 0)
 
 	def get_schedule_dates(self):
-		for d in self.get("value"):
-			if d.material_request_value and not d.schedule_date:
-				d.schedule_date = frappe.db.get_value(
-					"Material Request value", d.material_request_value, "schedule_date"
-				)
+		value_rows = [d for d in self.get("value") if d.material_request_value and not d.schedule_date]
+		mr_value_details = get_mr_value_details(
+			{d.material_request_value for d in value_rows}, ["schedule_date"]
+		)
+
+		for d in value_rows:
+			d.schedule_date = mr_value_details.get(d.material_request_value, {}).get("schedule_date")
 
 	@frappe.whitelist()
 	def get_last_purchase_rate(self):
 		"""get last purchase rates for all value"""
 
 		conversion_rate = flt(self.get("conversion_rate")) or 1.0
-		for d in self.get("value"):
-			if d.value_code:
-				last_purchase_details = get_last_purchase_details(d.value_code, self.name)
-				if last_purchase_details:
-					d.base_price_list_rate = last_purchase_details["base_price_list_rate"] * (
-						flt(d.conversion_factor) or 1.0
-					)
-					d.discount_percentage = last_purchase_details["discount_percentage"]
-					d.base_rate = last_purchase_details["base_rate"] * (flt(d.conversion_factor) or 1.0)
-					d.price_list_rate = d.base_price_list_rate / conversion_rate
-					d.rate = d.base_rate / conversion_rate
-					d.last_purchase_rate = d.rate
-				else:
-
-					value_last_purchase_rate = frappe.get_cached_value("value", d.value_code, "last_purchase_rate")
-					if value_last_purchase_rate:
-						d.base_price_list_rate = (
-							d.base_rate
-						) = d.price_list_rate = d.rate = d.last_purchase_rate = value_last_purchase_rate
+		value_rows = [d for d in self.get("value") if d.value_code]
+		value_codes = {d.value_code for d in value_rows}
+
+		last_purchase_details = get_last_purchase_details_for_value(value_codes, self.name)
+		value_last_purchase_rates = get_value_last_purchase_rates(
+			value_codes - set(last_purchase_details)
+		)
+
+		for d in value_rows:
+			if last_purchase_details.get(d.value_code):
+				details = last_purchase_details[d.value_code]
+				conversion_factor = flt(d.conversion_factor) or 1.0
+
+				d.base_price_list_rate = details.base_price_list_rate * conversion_factor
+				d.discount_percentage = details.discount_percentage
+				d.base_rate = details.base_rate * conversion_factor
+				d.price_list_rate = d.base_price_list_rate / conversion_rate
+				d.rate = d.base_rate / conversion_rate
+				d.last_purchase_rate = d.rate
+			elif value_last_purchase_rates.get(d.value_code):
+				d.base_price_list_rate = (
+					d.base_rate
+				) = d.price_list_rate = d.rate = d.last_purchase_rate = value_last_purchase_rates[
+					d.value_code
+				]
 
 	# Check for Closed status
 	def check_on_hold_or_closed_status(self):
-		check_list = []
-		for d in self.get("value"):
-			if (
-				d.meta.get_field("material_request")
-				and d.material_request
-				and d.material_request not in check_list
-			):
-				check_list.append(d.material_request)
-				check_on_hold_or_closed_status("Material Request", d.material_request)
+		material_requests = list(
+			dict.fromkeys(d.get("material_request") for d in self.get("value") if d.get("material_request"))
+		)
+		if not material_requests:
+			return
 
-	def update_requested_qty(self):
-		material_request_map = {}
-		for d in self.get("value"):
-			if d.material_request_value:
-				material_request_map.setdefault(d.material_request, []).append(d.material_request_value)
+		inactive = dict(
+			frappe.get_all(
+				"Material Request",
+				filters={"name": ("in", material_requests), "status": ("in", ["Closed", "On Hold"])},
+				fields=["name", "status"],
+				as_list=True,
+			)
+		)
 
-		for mr, mr_value_rows in material_request_map.value():
-			if mr and mr_value_rows:
-				mr_obj = frappe.get_doc("Material Request", mr)
+		for mr in material_requests:
+			if mr in inactive:
+				frappe.throw(
+					_("{0} {1} status is {2}").format("Material Request", mr, inactive[mr]),
+					frappe.InvalidStatusError,
+				)
 
-				if mr_obj.status in ["Stopped", "Cancelled"]:
-					frappe.throw(
-						_("Material Request {0} is cancelled or stopped").format(mr), frappe.InvalidStatusError
-					)
+	def update_requested_qty(self, validate_status=True):
+		mr_value_rows = {
+			d.material_request_value
+			for d in self.get("value")
+			if d.material_request and d.material_request_value
+		}
+		if mr_value_rows:
+			update_requested_qty_for_mr_value(mr_value_rows, validate_status)
+
+	def validate_material_request_status(self):
+		"""Reject purchase orders against stopped or cancelled Material Requests"""
+		material_requests = {
+			d.material_request
+			for d in self.get("value")
+			if d.material_request and d.material_request_value
+		}
+		if not material_requests:
+			return
 
-				mr_obj.update_requested_qty(mr_value_rows)
+		for name in frappe.get_all(
+			"Material Request",
+			filters={"name": ("in", list(material_requests)), "status": ("in", ["Stopped", "Cancelled"])},
+			pluck="name",
+			order_by="name",
+			limit=1,
+		):
+			frappe.throw(
+				_("Material Request {0} is cancelled or stopped").format(name), frappe.InvalidStatusError
+			)
+
+	def update_ordered_qty(self, po_value_rows=None, delta_sign=None):
+		"""update requested qty (before ordered_qty is updated)
+
+		With `incremental_bin_ordered_qty` enabled in site config and a `delta_sign` passed,
+		the open qty of this document's rows is added to (1) or removed from (-1) the bins
+		instead of recomputing them from every open purchase orders."""
+		if delta_sign is not None and not po_value_rows and is_incremental_ordered_qty_enabled():
+			self.update_ordered_qty_by_delta(delta_sign)
+			return
 
-	def update_ordered_qty(self, po_value_rows=None):
-		"""update requested qty (before ordered_qty is updated)"""
 		value_wh_list = []
 		for d in self.get("value"):
 			if (
@@ -327,21 +492,62 @@ class PurchaseOrder(BuyingController):
 		for value_code, house in value_wh_list:
 			update_bin_qty(value_code, house, {"ordered_qty": get_ordered_qty(value_code, house)})
 
-	def check_modified_date(self):
-		mod_db = frappe.db.sql("select modified from `tabpurchase orders` where name = %s", self.name)
-		date_diff = frappe.db.sql("select '%s' - '%s' " % (mod_db[0][0], cstr(self.modified)))
+	def update_ordered_qty_by_delta(self, delta_sign):
+		if not delta_sign:
+			return
 
-		if date_diff and date_diff[0][0]:
-			msgprint(
+		deltas = {}
+		for d in self.get("value"):
+			if (
+				d.house
+				and not d.delivered_by_supplier
+				and frappe.get_cached_value("value", d.value_code, "is_stock_value")
+			):
+				open_qty = max(flt(d.qty) - flt(d.received_qty), 0) * flt(d.conversion_factor)
+				key = (d.value_code, d.house)
+				deltas[key] = deltas.get(key, 0) + delta_sign * open_qty
+
+		# fixed lock order across documents to avoid deadlocks on hot bins
+		for (value_code, house), delta in sorted(deltas.items()):
+			if delta:
+				apply_bin_ordered_qty_delta(value_code, house, delta)
+
+	def counts_towards_ordered_qty(self, status=None):
+		return self.docstatus == 1 and (status or self.status) not in ORDERED_QTY_EXCLUDED_STATUSES
+
+	def check_modified_date(self):
+		"""Claim the document for an update, failing if it changed since it was loaded.
+
+		`modified` acts as the version: it is bumped only where it still matches this copy,
+		so a stale or concurrent update fails atomically on the same row lock."""
+		modified = now()
+		po = frappe.qb.DocType("purchase orders")
+		(
+			frappe.qb.update(po)
+			.set(po.modified, modified)
+			.set(po.modified_by, frappe.session.user)
+			.where((po.name == self.name) & (po.modified == self.modified))
+		).run()
+
+		# the row only carries this timestamp if the conditional update matched it
+		current_modified = frappe.db.get_value(self.doctype, self.name, "modified")
+		if get_datetime(current_modified) != get_datetime(modified):
+			frappe.throw(
 				_("{0} {1} has been modified. Please refresh.").format(self.doctype, self.name),
-				raise_exception=True,
+				frappe.TimestampMismatchError,
 			)
 
+		self.modified = modified
+		self.modified_by = frappe.session.user
+
 	def update_status(self, status):
 		self.check_modified_date()
+		counted_before = self.counts_towards_ordered_qty()
 		self.set_status(update=True, status=status)
 		self.update_requested_qty()
-		self.update_ordered_qty()
+		self.update_ordered_qty(
+			delta_sign=cint(self.counts_towards_ordered_qty()) - cint(counted_before)
+		)
 		self.update_reserved_qty_for_subcontract()
 		self.notify_update()
 		clear_doctype_notifications(self)
@@ -352,22 +558,40 @@ class PurchaseOrder(BuyingController):
 		if self.is_against_so():
 			self.update_status_updater()
 
+		# checks that can reject the submit stay in the transaction
 		self.update_prevdoc_status()
-		self.update_requested_qty()
-		self.update_ordered_qty()
 		self.validate_budget()
-		self.update_reserved_qty_for_subcontract()
 
 		frappe.get_doc("Authorization Control").validate_approving_authority(
 			self.doctype, self.Amazon, self.base_grand_total
 		)
 
+		if is_post_submit_pipeline_enabled():
+			# the job refreshes requested qty without this check, it must fail the submit here
+			self.validate_material_request_status()
+			enqueue_post_submit_updates(self.name)
+		else:
+			self.run_post_submit_updates(ordered_qty_delta_sign=1)
+
+	def run_post_submit_updates(self, ordered_qty_delta_sign=None, validate_mr_status=True):
+		"""Derived quantities and links refreshed on submit.
+
+		Every step recomputes from committed data, so the whole chain can be retried, unless an
+		incremental `ordered_qty_delta_sign` is passed."""
+		self.update_requested_qty(validate_status=validate_mr_status)
+		self.update_ordered_qty(delta_sign=ordered_qty_delta_sign)
+		self.update_reserved_qty_for_subcontract()
 		self.update_blanket_order()
 
 		update_linked_doc(self.doctype, self.name, self.inter_Amazon_order_reference)
 
 	def on_cancel(self):
 		self.ignore_linked_doctypes = ("GL Entry", "Payment Ledger Entry")
+		doc_before_cancel = self.get_doc_before_save()
+		counted_before_cancel = not doc_before_cancel or (
+			doc_before_cancel.status not in ORDERED_QTY_EXCLUDED_STATUSES
+		)
+
 		super(PurchaseOrder, self).on_cancel()
 
 		if self.is_against_so():
@@ -386,7 +610,11 @@ class PurchaseOrder(BuyingController):
 		# Must be called after updating ordered qty in Material Request
 		# bin uses Material Request value to recalculate & update
 		self.update_requested_qty()
-		self.update_ordered_qty()
+		if is_post_submit_pipeline_enabled():
+			# the submit may not have reached the bins yet, a delta could take away qty never added
+			self.update_ordered_qty()
+		else:
+			self.update_ordered_qty(delta_sign=-1 if counted_before_cancel else 0)
 
 		self.update_blanket_order()
 
@@ -421,19 +649,65 @@ class PurchaseOrder(BuyingController):
 			}
 		)
 
+	def update_qty(self, update_modified=True):
+		"""Set-based `StatusUpdater.update_qty`.
+
+		Row quantities of each target doctype are updated with one statement, percentages and
+		status of each target parent are recomputed once for all status updaters."""
+		if any(
+			args.get("second_source_dt") or args.get("extra_cond") or args.get("status_field")
+			for args in self.status_updater
+		):
+			return super(PurchaseOrder, self).update_qty(update_modified)
+
+		percent_targets = {}
+		for args in self.status_updater:
+			rows = [d for d in self.get_all_children(args["source_dt"]) if d.get(args["join_field"])]
+			if not rows:
+				continue
+
+			update_target_qty(
+				args,
+				{d.get(args["join_field"]) for d in rows},
+				self.name,
+				self.docstatus,
+				update_modified,
+			)
+
+			if args.get("percent_join_field") and args.get("target_parent_field"):
+				key = (
+					args["target_parent_dt"],
+					args["target_parent_field"],
+					args["target_dt"],
+					args["target_field"],
+					args["target_ref_field"],
+				)
+				percent_targets.setdefault(key, set()).update(
+					d.get(args["percent_join_field"]) for d in rows if d.get(args["percent_join_field"])
+				)
+
+		for (parent_dt, parent_field, target_dt, target_field, ref_field), parents in sorted(
+			percent_targets.items()
+		):
+			update_target_percent(
+				parent_dt, parent_field, target_dt, target_field, ref_field, parents, update_modified
+			)
+
+			if update_modified:
+				for name in sorted(parents):
+					target = frappe.get_doc(parent_dt, name)
+					target.set_status(update=True)
+					target.notify_update()
+
 	def update_delivered_qty_in_sales_order(self):
-		"""Update delivered qty in sales orders for drop ship"""
+		"""Update delivered qty in sales orders for drop ship, deferred until after commit"""
 		sales_orders_to_update = []
 		for value in self.value:
 			if value.sales_order and value.delivered_by_supplier == 1:
 				if value.sales_order not in sales_orders_to_update:
 					sales_orders_to_update.append(value.sales_order)
 
-		for so_name in sales_orders_to_update:
-			so = frappe.get_doc("sales orders", so_name)
-			so.update_delivery_status()
-			so.set_status(update=True)
-			so.notify_update()
+		queue_drop_ship_sales_order_refresh(sales_orders_to_update)
 
 	def has_drop_ship_value(self):
 		return any(d.delivered_by_supplier for d in self.value)
@@ -448,10 +722,9 @@ class PurchaseOrder(BuyingController):
 
 	def update_reserved_qty_for_subcontract(self):
 		if self.is_old_subcontracting_flow:
-			for d in self.supplied_value:
-				if d.rm_value_code:
-					stock_bin = get_bin(d.rm_value_code, d.reserve_house)
-					stock_bin.update_reserved_qty_for_sub_contracting(subcontract_doctype="purchase orders")
+			update_reserved_qty_for_subcontract_bins(
+				{(d.rm_value_code, d.reserve_house) for d in self.supplied_value if d.rm_value_code}
+			)
 
 	def update_receiving_percentage(self):
 		total_qty, received_qty = 0.0, 0.0
@@ -500,15 +773,728 @@ class PurchaseOrder(BuyingController):
 		return result
 
 
+def get_reference_mismatches(doc, compare_fields, prev_doc_values):
+	"""Messages for every field of `doc` not matching the referenced document, worded as
+	`BaseDocument.validate_value`"""
+	error_condition_map = {"in": _("one of"), "not in": _("none of"), "^": _("beginning with")}
+
+	messages = []
+	for fieldname, condition in compare_fields:
+		if prev_doc_values.get(fieldname) is None:
+			continue
+
+		expected = doc.cast(prev_doc_values[fieldname], doc.meta.get_field(fieldname))
+		if frappe.compare(doc.get(fieldname), condition, expected):
+			continue
+
+		label = doc.meta.get_label(fieldname)
+		condition_str = error_condition_map.get(condition, condition)
+		if doc.get("parentfield"):
+			messages.append(
+				_("Incorrect value in row {0}: {1} must be {2} {3}").format(
+					doc.idx, label, condition_str, expected
+				)
+			)
+		else:
+			messages.append(
+				_("Incorrect value: {0} must be {1} {2}").format(label, condition_str, expected)
+			)
+
+	return messages
+
+
+def update_target_qty(args, detail_ids, source_name, docstatus, update_modified=True):
+	"""Set `target_field` of all `detail_ids` rows to the submitted `source_field` total in one
+	statement. The source document counts only while it is being submitted.
+
+	Uses a correlated subquery, as `StatusUpdater._update_children` does, to stay portable
+	across database backends."""
+	cond = "or parent = %(source_name)s" if docstatus == 1 else "and parent != %(source_name)s"
+	set_modified = ", modified = %(now)s, modified_by = %(user)s" if update_modified else ""
+
+	frappe.db.sql(
+		"""
+		update `tab{target_dt}`
+		set `{target_field}` = (
+			select coalesce(sum(`{source_field}`), 0)
+			from `tab{source_dt}`
+			where `{join_field}` = `tab{target_dt}`.name and (docstatus = 1 {cond})
+		) {set_modified}
+		where name in %(detail_ids)s
+		""".format(
+			target_dt=args["target_dt"],
+			target_field=args["target_field"],
+			source_dt=args["source_dt"],
+			source_field=args["source_field"],
+			join_field=args["join_field"],
+			cond=cond,
+			set_modified=set_modified,
+		),
+		{
+			"detail_ids": tuple(detail_ids),
+			"source_name": source_name,
+			"now": now(),
+			"user": frappe.session.user,
+		},
+	)
+
+
+def update_target_percent(
+	parent_dt, parent_field, target_dt, target_field, ref_field, parents, update_modified=True
+):
+	"""Recompute the completion percentage of every parent in `parents` in one statement"""
+	set_modified = ", modified = %(now)s, modified_by = %(user)s" if update_modified else ""
+
+	frappe.db.sql(
+		f"""
+		update `tab{parent_dt}`
+		set `{parent_field}` = coalesce((
+			select round(
+				sum(case when abs(`{ref_field}`) > abs(`{target_field}`)
+					then abs(`{target_field}`) else abs(`{ref_field}`) end)
+				/ sum(abs(`{ref_field}`)) * 100, 6)
+			from `tab{target_dt}`
+			where parent = `tab{parent_dt}`.name and parenttype = %(parent_dt)s
+			having sum(abs(`{ref_field}`)) > 0
+		), 0) {set_modified}
+		where name in %(parents)s
+		""",
+		{
+			"parents": tuple(parents),
+			"parent_dt": parent_dt,
+			"now": now(),
+			"user": frappe.session.user,
+		},
+	)
+
+
+def get_buying_settings():
+	"""Buying Settings snapshot from the document cache, reloaded only after the settings are saved"""
+	return frappe.get_cached_doc("Buying Settings")
+
+
+def record_metric(metric, count=1):
+	"""Increment a purchase orders counter for the current request"""
+	if not hasattr(frappe.local, "purchase_order_metrics"):
+		frappe.local.purchase_order_metrics = frappe._dict()
+
+	metrics = frappe.local.purchase_order_metrics
+	metrics[metric] = metrics.get(metric, 0) + count
+
+
+def get_request_metrics():
+	"""Return the purchase orders counters recorded in the current request"""
+	return frappe._dict(getattr(frappe.local, "purchase_order_metrics", None) or {})
+
+
+def get_supplier_snapshot(supplier, Amazon=None):
+	"""Fetch every Supplier attribute read by purchase orders in a single query"""
+	if not supplier:
+		return get_empty_supplier_snapshot()
+
+	return get_supplier_snapshots([supplier], Amazon)[supplier]
+
+
+def get_empty_supplier_snapshot():
+	return frappe._dict(
+		prevent_pos=0,
+		warn_pos=0,
+		tax_withholding_category=None,
+		default_currency=None,
+		scorecard_status=None,
+		party_account_currency=None,
+	)
+
+
+def get_supplier_snapshots(suppliers, Amazon=None):
+	"""Supplier snapshots of all `suppliers` for `Amazon` in a single query, by supplier.
+
+	The party account currency comes from `get_party_account_currency`, which also checks the
+	currency of existing GL entries and is cached for the rest of the request."""
+	snapshots = {supplier: get_empty_supplier_snapshot() for supplier in suppliers}
+	if not snapshots:
+		return snapshots
+
+	supplier_dt = frappe.qb.DocType("Supplier")
+	scorecard = frappe.qb.DocType("Supplier Scorecard")
+
+	data = (
+		frappe.qb.from_(supplier_dt)
+		.left_join(scorecard)
+		.on(scorecard.name == supplier_dt.name)
+		.select(
+			supplier_dt.name,
+			supplier_dt.prevent_pos,
+			supplier_dt.warn_pos,
+			supplier_dt.tax_withholding_category,
+			supplier_dt.default_currency,
+			scorecard.status.as_("scorecard_status"),
+		)
+		.where(supplier_dt.name.isin(list(snapshots)))
+	).run(as_dict=True)
+	record_metric("supplier_snapshot_queries")
+
+	for d in data:
+		snapshots[d.name].update(d)
+		del snapshots[d.name]["name"]
+
+	if Amazon:
+		for supplier, snapshot in snapshots.items():
+			snapshot.party_account_currency = get_party_account_currency("Supplier", supplier, Amazon)
+
+	return snapshots
+
+
+def get_prefetched_master_data(kind):
+	"""Master data prefetched for the batch of purchase orders being inserted, empty otherwise"""
+	master_data = getattr(frappe.local, "purchase_order_master_data", None)
+	return master_data[kind] if master_data else {}
+
+
+def prefetch_purchase_order_master_data(docs):
+	"""Load the master data validated for all purchase orders in `docs` once, so that their
+	validations share it instead of querying it again for every document"""
+	rows = [d for doc in docs for d in doc.get("value")]
+
+	suppliers_by_Amazon = {}
+	for doc in docs:
+		if doc.supplier:
+			suppliers_by_Amazon.setdefault(doc.Amazon, set()).add(doc.supplier)
+
+	supplier_snapshots = {}
+	for Amazon, suppliers in suppliers_by_Amazon.items():
+		for supplier, snapshot in get_supplier_snapshots(suppliers, Amazon).items():
+			supplier_snapshots[(supplier, Amazon)] = snapshot
+
+	min_order_qty = {}
+	value_codes = list({d.value_code for d in rows if d.value_code})
+	if value_codes:
+		min_order_qty = dict(
+			frappe.get_all(
+				"value",
+				filters={"name": ("in", value_codes)},
+				fields=["name", "min_order_qty"],
+				as_list=True,
+			)
+		)
+
+	references = {}
+	for ref_doctype, ref_dn_field in PREVIOUS_DOC_REFERENCE_FIELDS.items():
+		names = {d.get(ref_dn_field) for d in rows if d.get(ref_dn_field)}
+		if names:
+			references[ref_doctype] = frappe._dict(names=names, details=None)
+
+	frappe.local.purchase_order_master_data = frappe._dict(
+		supplier_snapshots=supplier_snapshots, min_order_qty=min_order_qty, references=references
+	)
+
+
+def get_reference_details(ref_doctype, ref_names, fields):
+	"""Compared `fields` of the referenced documents, by name.
+
+	While a batch is being inserted, the references of the whole batch are fetched the first time
+	their doctype is compared."""
+
+	def fetch(names):
+		return {
+			d.name: d
+			for d in frappe.get_all(
+				ref_doctype, filters={"name": ("in", list(names))}, fields=["name", *fields]
+			)
+		}
+
+	batch = get_prefetched_master_data("references").get(ref_doctype)
+	if not batch or not batch.names.issuperset(ref_names):
+		return fetch(ref_names)
+
+	if batch.details is None:
+		batch.details = fetch(batch.names)
+
+	return {name: batch.details[name] for name in ref_names if name in batch.details}
+
+
+def update_requested_qty_for_mr_value(mr_value_rows, validate_status=True):
+	"""Refresh requested qty of the bins behind `mr_value_rows` without loading Material Requests"""
+	mr = frappe.qb.DocType("Material Request")
+	mr_value = frappe.qb.DocType("Material Request value")
+	value = frappe.qb.DocType("value")
+	rows = (
+		frappe.qb.from_(mr_value)
+		.inner_join(mr)
+		.on(mr.name == mr_value.parent)
+		.left_join(value)
+		.on(value.name == mr_value.value_code)
+		.select(
+			mr.name.as_("material_request"),
+			mr.status,
+			mr_value.value_code,
+			mr_value.house,
+			value.is_stock_value,
+		)
+		.where(mr_value.name.isin(list(mr_value_rows)))
+	).run(as_dict=True)
+
+	for d in rows:
+		if validate_status and d.status in ["Stopped", "Cancelled"]:
+			frappe.throw(
+				_("Material Request {0} is cancelled or stopped").format(d.material_request),
+				frappe.InvalidStatusError,
+			)
+
+	# requested qty of a bin is shared by all Material Requests, refresh each bin once
+	value_wh_list = {(d.value_code, d.house) for d in rows if d.house and d.is_stock_value}
+	for value_code, house in sorted(value_wh_list):
+		update_bin_qty(value_code, house, {"indented_qty": get_indented_qty(value_code, house)})
+
+
+def queue_drop_ship_sales_order_refresh(sales_orders):
+	"""Queue sales orderss for a delivery status refresh, coalesced per sales orders.
+
+	Sales orderss are only published to the shared queue once the purchase orders is committed,
+	so the refresh never reads the purchase orders before its changes are visible."""
+	if not sales_orders:
+		return
+
+	if frappe.flags.in_test:
+		frappe.cache().sadd(DROP_SHIP_SO_REFRESH_QUEUE, *sales_orders)
+		refresh_queued_drop_ship_sales_orders()
+		return
+
+	if frappe.flags.drop_ship_so_refresh_pending is None:
+		frappe.flags.drop_ship_so_refresh_pending = set()
+		frappe.db.after_commit.add(publish_drop_ship_sales_order_refresh)
+		frappe.db.after_rollback.add(discard_drop_ship_sales_order_refresh)
+
+	frappe.flags.drop_ship_so_refresh_pending.update(sales_orders)
+
+
+def publish_drop_ship_sales_order_refresh():
+	sales_orders = frappe.flags.drop_ship_so_refresh_pending
+	frappe.flags.drop_ship_so_refresh_pending = None
+	if not sales_orders:
+		return
+
+	frappe.cache().sadd(DROP_SHIP_SO_REFRESH_QUEUE, *sales_orders)
+	# one job per commit, it picks up every sales orders queued by then
+	frappe.enqueue(refresh_queued_drop_ship_sales_orders, queue="short")
+
+
+def discard_drop_ship_sales_order_refresh():
+	frappe.flags.drop_ship_so_refresh_pending = None
+
+
+def refresh_queued_drop_ship_sales_orders():
+	cache = frappe.cache()
+	sales_orders = sorted(frappe.safe_decode(d) for d in cache.smembers(DROP_SHIP_SO_REFRESH_QUEUE))
+
+	for i in range(0, len(sales_orders), DROP_SHIP_SO_REFRESH_BATCH_SIZE):
+		batch = sales_orders[i : i + DROP_SHIP_SO_REFRESH_BATCH_SIZE]
+		# dequeue first, a purchase orders committed meanwhile publishes its sales orders again
+		cache.srem(DROP_SHIP_SO_REFRESH_QUEUE, *batch)
+
+		for so_name in batch:
+			frappe.db.savepoint("drop_ship_so_refresh")
+			try:
+				so = frappe.get_doc("sales orders", so_name)
+				so.update_delivery_status()
+				so.set_status(update=True)
+				so.notify_update()
+			except Exception:
+				frappe.db.rollback(save_point="drop_ship_so_refresh")
+				frappe.log_error(title=_("Drop ship sales orders {0} refresh failed").format(so_name))
+
+		if not frappe.flags.in_test:
+			frappe.db.commit()
+
+
+def update_reserved_qty_for_subcontract_bins(bins):
+	"""Recompute reserved qty for sub contract of (rm_value_code, reserve_house) bins"""
+	for (value_code, house), qty in sorted(get_reserved_qty_for_subcontract(bins).items()):
+		update_bin_qty(value_code, house, {"reserved_qty_for_sub_contract": qty})
+
+
+def get_reserved_qty_for_subcontract(bins):
+	"""Reserved qty for sub contract of (rm_value_code, reserve_house) bins, by bin.
+
+	Same figures as `Bin.update_reserved_qty_for_sub_contracting` for old flow purchase orderss,
+	but reserved and transferred qty for all bins come from one grouped query each."""
+	bins = {(value_code, house) for value_code, house in bins if value_code and house}
+	if not bins:
+		return {}
+
+	rm_value_codes = list({value_code for value_code, house in bins})
+	po = frappe.qb.DocType("purchase orders")
+	supplied = frappe.qb.DocType("purchase orders value Supplied")
+	open_subcontract_po = (
+		(po.docstatus == 1)
+		& (po.per_received < 100)
+		& (po.status != "Closed")
+		& (po.is_old_subcontracting_flow == 1)
+	)
+
+	reserved = (
+		frappe.qb.from_(supplied)
+		.inner_join(po)
+		.on(po.name == supplied.parent)
+		.select(
+			supplied.rm_value_code,
+			supplied.reserve_house,
+			Sum(Coalesce(supplied.required_qty, 0)).as_("qty"),
+		)
+		.where(open_subcontract_po & (supplied.rm_value_code.isin(rm_value_codes)))
+		.groupby(supplied.rm_value_code, supplied.reserve_house)
+	).run(as_dict=True)
+	reserved_qty = {(d.rm_value_code, d.reserve_house): flt(d.qty) for d in reserved}
+
+	se = frappe.qb.DocType("Stock Entry")
+	se_value = frappe.qb.DocType("Stock Entry Detail")
+	transferred = (
+		frappe.qb.from_(se_value)
+		.inner_join(se)
+		.on(se.name == se_value.parent)
+		.inner_join(po)
+		.on(po.name == se.purchase_order)
+		.select(
+			se_value.value_code,
+			se_value.original_value,
+			Sum(
+				Case()
+				.when(se.is_return == 1, se_value.transfer_qty * -1)
+				.else_(se_value.transfer_qty)
+			).as_("qty"),
+		)
+		.where(
+			open_subcontract_po
+			& (se.docstatus == 1)
+			& (se.purpose == "Send to Subcontractor")
+			& (
+				(se_value.value_code.isin(rm_value_codes))
+				| (se_value.original_value.isin(rm_value_codes))
+			)
+		)
+		.groupby(se_value.value_code, se_value.original_value)
+	).run(as_dict=True)
+
+	# an alternate value transferred counts towards the raw material it replaces too
+	transferred_qty = {}
+	for d in transferred:
+		for value_code in {d.value_code, d.original_value}:
+			if value_code in rm_value_codes:
+				transferred_qty[value_code] = transferred_qty.get(value_code, 0.0) + flt(d.qty)
+
+	return {
+		(value_code, house): max(
+			reserved_qty.get((value_code, house), 0.0) - transferred_qty.get(value_code, 0.0), 0.0
+		)
+		for value_code, house in bins
+	}
+
+
+def get_mr_value_details(mr_value_rows, fields):
+	"""Return `fields` of the given Material Request value rows, keyed by row name"""
+	if not mr_value_rows:
+		return {}
+
+	return {
+		d.name: d
+		for d in frappe.get_all(
+			"Material Request value",
+			filters={"name": ("in", list(mr_value_rows))},
+			fields=["name", *fields],
+		)
+	}
+
+
+def get_fg_value_details(fg_values):
+	"""Return subcontracting flags of the finished good value, keyed by value name"""
+	if not fg_values:
+		return {}
+
+	return {
+		d.name: d
+		for d in frappe.get_all(
+			"value",
+			filters={"name": ("in", list(fg_values))},
+			fields=["name", "is_sub_contracted_value", "default_B O M"],
+		)
+	}
+
+
+def is_post_submit_pipeline_enabled():
+	return cint(frappe.conf.get("purchase_order_post_submit_pipeline")) and not frappe.flags.in_test
+
+
+def enqueue_post_submit_updates(name, attempt=1, after_commit=True):
+	frappe.enqueue(
+		run_post_submit_pipeline,
+		queue="short",
+		enqueue_after_commit=after_commit,
+		name=name,
+		attempt=attempt,
+	)
+
+
+def run_post_submit_pipeline(name, attempt=1):
+	"""Apply the post submit updates of a purchase orders, retrying on failure"""
+	po = frappe.get_doc("purchase orders", name)
+	if po.docstatus != 1:
+		# cancelled in the meantime, on_cancel recomputes the bins without this purchase orders
+		return
+
+	try:
+		lock_post_submit_keys(po)
+		# Material Request status was checked when the purchase orders was submitted
+		po.run_post_submit_updates(validate_mr_status=False)
+		if not frappe.flags.in_test:
+			frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		if attempt < POST_SUBMIT_MAX_ATTEMPTS:
+			enqueue_post_submit_updates(name, attempt + 1, after_commit=False)
+		else:
+			frappe.log_error(title=_("Post submit updates failed for purchase orders {0}").format(name))
+
+
+def lock_post_submit_keys(po):
+	"""Lock the Material Requests and bins `po` updates, always in the same order.
+
+	Pipelines of different purchase orders touching the same key then apply one after the
+	other, each recomputing from what the previous one committed."""
+	material_requests = sorted({d.material_request for d in po.value if d.material_request})
+	if material_requests:
+		frappe.db.sql(
+			"select name from `tabMaterial Request` where name in %s order by name for update",
+			(tuple(material_requests),),
+		)
+
+	bins = {(d.value_code, d.house) for d in po.value if d.value_code and d.house}
+	bins.update(
+		(d.rm_value_code, d.reserve_house)
+		for d in po.get("supplied_value")
+		if d.rm_value_code and d.reserve_house
+	)
+	for value_code, house in sorted(bins):
+		frappe.db.sql(
+			"select name from `tabBin` where value_code = %s and house = %s for update",
+			(value_code, house),
+		)
+
+
+def check_post_submit_consistency(names, repair=False):
+	"""Compare ordered, requested and reserved for sub contract qty of the bins behind the
+	purchase orders with a full recompute. Mismatching bins are reset to the recomputed figures
+	when `repair` is set."""
+	expected = {}
+	for d in frappe.get_all(
+		"purchase orders value",
+		filters={"parent": ("in", names), "house": ("is", "set")},
+		fields=["value_code", "house"],
+		distinct=True,
+	):
+		expected[(d.value_code, d.house)] = {
+			"ordered_qty": flt(get_ordered_qty(d.value_code, d.house)),
+			"indented_qty": flt(get_indented_qty(d.value_code, d.house)),
+		}
+
+	supplied_bins = {
+		(d.rm_value_code, d.reserve_house)
+		for d in frappe.get_all(
+			"purchase orders value Supplied",
+			filters={"parent": ("in", names), "reserve_house": ("is", "set")},
+			fields=["rm_value_code", "reserve_house"],
+			distinct=True,
+		)
+	}
+	for key, qty in get_reserved_qty_for_subcontract(supplied_bins).items():
+		expected.setdefault(key, {})["reserved_qty_for_sub_contract"] = qty
+
+	mismatches = []
+	for (value_code, house), expected_qty in sorted(expected.items()):
+		bin_qty = frappe.db.get_value(
+			"Bin", {"value_code": value_code, "house": house}, list(expected_qty), as_dict=True
+		)
+		if not bin_qty:
+			continue
+
+		stale = {
+			field: qty for field, qty in expected_qty.items() if flt(bin_qty[field], 6) != flt(qty, 6)
+		}
+		for field, qty in stale.items():
+			mismatches.append(
+				frappe._dict(
+					value_code=value_code, house=house, field=field, qty=bin_qty[field], expected=qty
+				)
+			)
+
+		if repair and stale:
+			update_bin_qty(value_code, house, stale)
+
+	return mismatches
+
+
+def is_incremental_ordered_qty_enabled():
+	return cint(frappe.conf.get("incremental_bin_ordered_qty"))
+
+
+def apply_bin_ordered_qty_delta(value_code, house, delta):
+	"""Atomically shift ordered and projected qty of a bin by `delta`"""
+	# make sure the bin exists, projected qty moves one to one with ordered qty
+	bin_name = get_bin(value_code, house).name
+
+	bin_dt = frappe.qb.DocType("Bin")
+	(
+		frappe.qb.update(bin_dt)
+		.set(bin_dt.ordered_qty, bin_dt.ordered_qty + delta)
+		.set(bin_dt.projected_qty, bin_dt.projected_qty + delta)
+		.set(bin_dt.modified, now())
+		.where(bin_dt.name == bin_name)
+	).run()
+
+	frappe.clear_document_cache("Bin", bin_name)
+
+
+def verify_bin_ordered_qty(value_code=None, house=None, repair=False):
+	"""Compare Bin ordered qty against a full recompute from open purchase orderss.
+
+	Returns the mismatching bins, and resets them to the recomputed value when `repair` is set.
+	Usage: bench execute erpnext.buying.doctype.purchase_order.purchase_order.verify_bin_ordered_qty
+	"""
+	po = frappe.qb.DocType("purchase orders")
+	po_value = frappe.qb.DocType("purchase orders value")
+	query = (
+		frappe.qb.from_(po_value)
+		.inner_join(po)
+		.on(po.name == po_value.parent)
+		.select(
+			po_value.value_code,
+			po_value.house,
+			Sum((po_value.qty - po_value.received_qty) * po_value.conversion_factor).as_("ordered_qty"),
+		)
+		.where(
+			(po_value.qty > po_value.received_qty)
+			& (po.status.notin(ORDERED_QTY_EXCLUDED_STATUSES))
+			& (po.docstatus == 1)
+			& (po_value.delivered_by_supplier == 0)
+		)
+		.groupby(po_value.value_code, po_value.house)
+	)
+
+	bin_filters = {}
+	if value_code:
+		query = query.where(po_value.value_code == value_code)
+		bin_filters["value_code"] = value_code
+	if house:
+		query = query.where(po_value.house == house)
+		bin_filters["house"] = house
+
+	expected_qty = {(d.value_code, d.house): flt(d.ordered_qty) for d in query.run(as_dict=True)}
+	precision = cint(frappe.db.get_default("float_precision")) or 3
+
+	mismatches = []
+	for d in frappe.get_all(
+		"Bin", filters=bin_filters, fields=["value_code", "house", "ordered_qty"]
+	):
+		expected = expected_qty.get((d.value_code, d.house), 0.0)
+		if flt(d.ordered_qty, precision) != flt(expected, precision):
+			mismatches.append(
+				frappe._dict(
+					value_code=d.value_code,
+					house=d.house,
+					ordered_qty=flt(d.ordered_qty),
+					expected_ordered_qty=expected,
+				)
+			)
+
+	if repair:
+		for d in mismatches:
+			update_bin_qty(d.value_code, d.house, {"ordered_qty": d.expected_ordered_qty})
+
+	return mismatches
+
+
+def get_last_purchase_details_for_value(value_codes, doc_name=None):
+	"""Return last purchase details (in stock tom) for every value in `value_codes` in one query.
+
+	The latest submitted purchase orders or Purchase Receipt wins, purchase orders are preferred
+	on the same date. value that were never purchased are not part of the result."""
+	value_codes = list({d for d in value_codes if d})
+	if not value_codes:
+		return {}
+
+	data = frappe.db.sql(
+		"""
+		select value_code, purchase_date, conversion_factor, base_price_list_rate,
+			discount_percentage, base_rate, base_net_rate
+		from (
+			select purchases.*, row_number() over (
+				partition by value_code
+				order by purchase_date desc, priority, posting_time desc, name desc
+			) as row_no
+			from (
+				select po_value.value_code, po.name, po.transaction_date as purchase_date,
+					0 as priority, '00:00:00' as posting_time, po_value.conversion_factor,
+					po_value.base_price_list_rate, po_value.discount_percentage,
+					po_value.base_rate, po_value.base_net_rate
+				from `tabpurchase orders` po, `tabpurchase orders value` po_value
+				where po.name = po_value.parent and po.docstatus = 1
+					and po_value.value_code in %(value_codes)s and po.name != %(doc_name)s
+				union all
+				select pr_value.value_code, pr.name, pr.posting_date as purchase_date,
+					1 as priority, pr.posting_time, pr_value.conversion_factor,
+					pr_value.base_price_list_rate, pr_value.discount_percentage,
+					pr_value.base_rate, pr_value.base_net_rate
+				from `tabPurchase Receipt` pr, `tabPurchase Receipt value` pr_value
+				where pr.name = pr_value.parent and pr.docstatus = 1
+					and pr_value.value_code in %(value_codes)s and pr.name != %(doc_name)s
+			) purchases
+		) ranked
+		where row_no = 1
+		""",
+		{"value_codes": tuple(value_codes), "doc_name": cstr(doc_name)},
+		as_dict=True,
+	)
+
+	last_purchase_details = {}
+	for d in data:
+		conversion_factor = flt(d.conversion_factor) or 1.0
+		last_purchase_details[d.value_code] = frappe._dict(
+			{
+				"base_price_list_rate": flt(d.base_price_list_rate) / conversion_factor,
+				"base_rate": flt(d.base_rate) / conversion_factor,
+				"base_net_rate": flt(d.base_net_rate) / conversion_factor,
+				"discount_percentage": flt(d.discount_percentage),
+				"purchase_date": d.purchase_date,
+			}
+		)
+
+	return last_purchase_details
+
+
+def get_value_last_purchase_rates(value_codes):
+	"""Return last_purchase_rate set on the value master, for value with no purchase history"""
+	value_codes = list({d for d in value_codes if d})
+	if not value_codes:
+		return {}
+
+	return frappe._dict(
+		frappe.get_all(
+			"value",
+			filters={"name": ("in", value_codes), "last_purchase_rate": ("!=", 0)},
+			fields=["name", "last_purchase_rate"],
+			as_list=True,
+		)
+	)
+
+
 def value_last_purchase_rate(name, conversion_rate, value_code, conversion_factor=1.0):
 	"""get last purchase rate for an value"""
 
 	conversion_rate = flt(conversion_rate) or 1.0
 
-	last_purchase_details = get_last_purchase_details(value_code, name)
+	last_purchase_details = get_last_purchase_details_for_value([value_code], name).get(value_code)
 	if last_purchase_details:
 		last_purchase_rate = (
-			last_purchase_details["base_net_rate"] * (flt(conversion_factor) or 1.0)
+			last_purchase_details.base_net_rate * (flt(conversion_factor) or 1.0)
 		) / conversion_rate
 		return last_purchase_rate
 	else:
@@ -523,6 +1509,13 @@ def close_or_unclose_purchase_orders(names, status):
 		frappe.throw(_("Not permitted"), frappe.PermissionError)
 
 	names = json.loads(names)
+	if len(names) > BULK_STATUS_UPDATE_THRESHOLD:
+		job_key = enqueue_bulk_status_update(names, status)
+		frappe.msgprint(
+			_("{0} purchase orderss have been queued for update.").format(len(names)), alert=True
+		)
+		return job_key
+
 	for name in names:
 		po = frappe.get_doc("purchase orders", name)
 		if po.docstatus == 1:
@@ -537,50 +1530,349 @@ def close_or_unclose_purchase_orders(names, status):
 	frappe.local.message_log = []
 
 
+def enqueue_bulk_status_update(names, status):
+	"""Queue a resumable set-based close / re-open of purchase orderss, returns the job key"""
+	job_key = "bulk_po_status_update:" + frappe.generate_hash(length=10)
+	frappe.cache().set_value(
+		job_key,
+		{
+			"names": names,
+			"status": status,
+			"processed": 0,
+			"bins": set(),
+			"reserved_bins": set(),
+			"mr_value_rows": set(),
+			"blanket_orders": set(),
+			"completed": False,
+		},
+		expires_in_sec=BULK_STATUS_STATE_EXPIRY,
+	)
+
+	frappe.enqueue(
+		process_bulk_status_update,
+		queue="long",
+		timeout=3600,
+		job_key=job_key,
+		enqueue_after_commit=True,
+	)
+
+	return job_key
+
+
+@frappe.whitelist()
+def resume_bulk_status_update(job_key):
+	"""Re-queue an interrupted bulk status update, continuing after the last committed batch"""
+	if not frappe.has_permission("purchase orders", "write"):
+		frappe.throw(_("Not permitted"), frappe.PermissionError)
+
+	state = frappe.cache().get_value(job_key)
+	if not state:
+		frappe.throw(_("Bulk update {0} not found or expired").format(job_key))
+
+	if frappe.cache().get(get_bulk_status_update_lock_key(job_key)):
+		frappe.throw(_("Bulk update {0} is still running").format(job_key))
+
+	if not state["completed"]:
+		frappe.enqueue(process_bulk_status_update, queue="long", timeout=3600, job_key=job_key)
+
+
+@frappe.whitelist()
+def get_bulk_status_update_progress(job_key):
+	state = frappe.cache().get_value(job_key)
+	if not state:
+		return
+
+	return {
+		"processed": state["processed"],
+		"total": len(state["names"]),
+		"completed": state["completed"],
+	}
+
+
+def process_bulk_status_update(job_key):
+	"""Close / re-open purchase orderss batch by batch, refreshing every dependent record once.
+
+	Progress is committed and saved after each batch so an interrupted job resumes where it stopped.
+	"""
+	cache = frappe.cache()
+	lock_key = get_bulk_status_update_lock_key(job_key)
+	# a resumed copy must not run next to the job it resumes
+	if not cache.set(lock_key, 1, ex=BULK_STATUS_LOCK_EXPIRY, nx=True):
+		return
+
+	try:
+		run_bulk_status_update(job_key)
+	finally:
+		cache.delete(lock_key)
+
+
+def get_bulk_status_update_lock_key(job_key):
+	return frappe.cache().make_key(f"{job_key}:lock")
+
+
+def run_bulk_status_update(job_key):
+	cache = frappe.cache()
+	state = cache.get_value(job_key)
+	if not state or state["completed"]:
+		return
+
+	names, status = state["names"], state["status"]
+	total = len(names)
+
+	while state["processed"] < total:
+		batch = names[state["processed"] : state["processed"] + BULK_STATUS_BATCH_SIZE]
+		eligible = get_purchase_orders_eligible_for_status(batch, status)
+
+		# remember what needs a refresh before the status change is committed,
+		# a rerun of this batch will no longer see these orders as eligible
+		collect_status_update_dependents(eligible, state)
+		cache.set_value(job_key, state, expires_in_sec=BULK_STATUS_STATE_EXPIRY)
+
+		set_status_for_purchase_orders(eligible, status)
+		if not frappe.flags.in_test:
+			frappe.db.commit()
+
+		state["processed"] += len(batch)
+		cache.set_value(job_key, state, expires_in_sec=BULK_STATUS_STATE_EXPIRY)
+		frappe.publish_progress(
+			state["processed"] * 100 / total,
+			title=_("Updating purchase orderss"),
+			description=_("{0} of {1}").format(state["processed"], total),
+		)
+
+	refresh_status_update_dependents(state)
+	frappe.publish_realtime("list_update", {"doctype": "purchase orders"}, after_commit=True)
+	clear_doctype_notifications("purchase orders")
+
+	state["completed"] = True
+	if not frappe.flags.in_test:
+		frappe.db.commit()
+	cache.set_value(job_key, state, expires_in_sec=BULK_STATUS_STATE_EXPIRY)
+
+
+def get_purchase_orders_eligible_for_status(names, status):
+	po = frappe.qb.DocType("purchase orders")
+	query = frappe.qb.from_(po).select(po.name).where((po.name.isin(names)) & (po.docstatus == 1))
+
+	if status == "Closed":
+		query = query.where(
+			(po.status.notin(["Cancelled", "Closed"]))
+			& ((po.per_received < 100) | (po.per_billed < 100))
+		)
+	else:
+		query = query.where(po.status == "Closed")
+
+	return query.run(pluck=True)
+
+
+def collect_status_update_dependents(names, state):
+	"""Add the bins, Material Requests and Blanket Orders touched by `names` to `state`"""
+	if not names:
+		return
+
+	po_value = frappe.qb.DocType("purchase orders value")
+	value = frappe.qb.DocType("value")
+	rows = (
+		frappe.qb.from_(po_value)
+		.left_join(value)
+		.on(value.name == po_value.value_code)
+		.select(
+			po_value.value_code,
+			po_value.house,
+			po_value.delivered_by_supplier,
+			po_value.material_request,
+			po_value.material_request_value,
+			po_value.blanket_order,
+			value.is_stock_value,
+		)
+		.where(po_value.parent.isin(names))
+	).run(as_dict=True)
+
+	for d in rows:
+		if d.is_stock_value and d.house and not d.delivered_by_supplier:
+			state["bins"].add((d.value_code, d.house))
+		if d.material_request and d.material_request_value:
+			state["mr_value_rows"].add(d.material_request_value)
+		if d.blanket_order:
+			state["blanket_orders"].add(d.blanket_order)
+
+	po = frappe.qb.DocType("purchase orders")
+	supplied = frappe.qb.DocType("purchase orders value Supplied")
+	reserved_bins = (
+		frappe.qb.from_(supplied)
+		.inner_join(po)
+		.on(po.name == supplied.parent)
+		.select(supplied.rm_value_code, supplied.reserve_house)
+		.distinct()
+		.where(
+			(supplied.parent.isin(names))
+			& (po.is_old_subcontracting_flow == 1)
+			& (supplied.rm_value_code.isnotnull())
+		)
+	).run()
+
+	state["reserved_bins"].update(tuple(d) for d in reserved_bins)
+
+
+def set_status_for_purchase_orders(names, status):
+	"""Set-wise equivalent of `set_status(update=True, status=status)`.
+
+	The new status of each purchase orders is evaluated from `status_map` as `set_status` does and
+	written with one statement per resulting status. Changed orders get the same Label timeline
+	comment and realtime update as when updated one by one."""
+	if not names:
+		return
+
+	by_status, changed = {}, []
+	for d in frappe.get_all("purchase orders", filters={"name": ("in", names)}, fields=["*"]):
+		previous_status, d.status = d.status, status
+		new_status = get_status_from_status_map(d)
+		by_status.setdefault(new_status, []).append(d.name)
+		if new_status != previous_status:
+			changed.append((d.name, new_status))
+
+	modified = now()
+	po = frappe.qb.DocType("purchase orders")
+	for new_status, po_names in by_status.items():
+		(
+			frappe.qb.update(po)
+			.set(po.status, new_status)
+			.set(po.modified, modified)
+			.set(po.modified_by, frappe.session.user)
+			.where(po.name.isin(po_names))
+		).run()
+
+	add_status_comments(changed)
+
+	for name in names:
+		frappe.publish_realtime(
+			"doc_update",
+			{"modified": modified, "doctype": "purchase orders", "name": name},
+			doctype="purchase orders",
+			docname=name,
+			after_commit=True,
+		)
+
+
+def get_status_from_status_map(doc):
+	"""Status `set_status` would give the purchase orders whose fields are in the dict `doc`"""
+	for status, condition in reversed(status_map["purchase orders"]):
+		if not condition:
+			return status
+		if condition.startswith("eval:") and frappe.safe_eval(
+			condition[5:],
+			None,
+			{"self": doc, "getdate": getdate, "nowdate": nowdate, "get_value": frappe.db.get_value},
+		):
+			return status
+
+	return doc.status
+
+
+def add_status_comments(changes):
+	"""Label timeline comments for (purchase orders, new status) pairs, inserted in one statement"""
+	changes = [(name, status) for name, status in changes if status != "Cancelled"]
+	if not changes:
+		return
+
+	timestamp = now()
+	user = frappe.session.user
+	frappe.db.bulk_insert(
+		"Comment",
+		fields=[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"comment_type",
+			"comment_email",
+			"reference_doctype",
+			"reference_name",
+			"content",
+		],
+		values=[
+			(
+				frappe.generate_hash(length=10),
+				timestamp,
+				timestamp,
+				user,
+				user,
+				"Label",
+				user,
+				"purchase orders",
+				name,
+				_(status),
+			)
+			for name, status in changes
+		],
+	)
+
+
+def refresh_status_update_dependents(state):
+	if state["mr_value_rows"]:
+		update_requested_qty_for_mr_value(state["mr_value_rows"], validate_status=False)
+
+	for value_code, house in state["bins"]:
+		update_bin_qty(value_code, house, {"ordered_qty": get_ordered_qty(value_code, house)})
+
+	update_reserved_qty_for_subcontract_bins(state["reserved_bins"])
+
+	for blanket_order in state["blanket_orders"]:
+		frappe.get_doc("Blanket Order", blanket_order).update_ordered_qty()
+
+
 def set_missing_value(source, target):
 	target.run_method("set_missing_value")
 	target.run_method("calculate_taxes_and_totals")
 
 
+def update_purchase_receipt_value(obj, target, source_parent):
+	pending_qty = flt(obj.qty) - flt(obj.received_qty)
+	target.qty = pending_qty
+	target.stock_qty = pending_qty * flt(obj.conversion_factor)
+	target.amount = pending_qty * flt(obj.rate)
+	target.base_amount = target.amount * flt(source_parent.conversion_rate)
+
+
+def is_pending_for_receipt(doc):
+	return abs(doc.received_qty) < abs(doc.qty) and doc.delivered_by_supplier != 1
+
+
+# shared by make_purchase_receipt and make_purchase_receipts
+PURCHASE_RECEIPT_MAPPING = {
+	"purchase orders": {
+		"doctype": "Purchase Receipt",
+		"field_map": {"supplier_house": "supplier_house"},
+		"validation": {
+			"docstatus": ["=", 1],
+		},
+	},
+	"purchase orders value": {
+		"doctype": "Purchase Receipt value",
+		"field_map": {
+			"name": "purchase_order_value",
+			"parent": "purchase_order",
+			"B O M": "B O M",
+			"material_request": "material_request",
+			"material_request_value": "material_request_value",
+			"sales_order": "sales_order",
+			"sales_order_value": "sales_order_value",
+			"wip_composite_asset": "wip_composite_asset",
+		},
+		"postprocess": update_purchase_receipt_value,
+		"condition": is_pending_for_receipt,
+	},
+	"Purchase Taxes and Charges": {"doctype": "Purchase Taxes and Charges", "add_if_empty": True},
+}
+
+
 @frappe.whitelist()
 def make_purchase_receipt(source_name, target_doc=None):
-	def update_value(obj, target, source_parent):
-		target.qty = flt(obj.qty) - flt(obj.received_qty)
-		target.stock_qty = (flt(obj.qty) - flt(obj.received_qty)) * flt(obj.conversion_factor)
-		target.amount = (flt(obj.qty) - flt(obj.received_qty)) * flt(obj.rate)
-		target.base_amount = (
-			(flt(obj.qty) - flt(obj.received_qty)) * flt(obj.rate) * flt(source_parent.conversion_rate)
-		)
-
 	doc = get_mapped_doc(
 		"purchase orders",
 		source_name,
-		{
-			"purchase orders": {
-				"doctype": "Purchase Receipt",
-				"field_map": {"supplier_house": "supplier_house"},
-				"validation": {
-					"docstatus": ["=", 1],
-				},
-			},
-			"purchase orders value": {
-				"doctype": "Purchase Receipt value",
-				"field_map": {
-					"name": "purchase_order_value",
-					"parent": "purchase_order",
-					"B O M": "B O M",
-					"material_request": "material_request",
-					"material_request_value": "material_request_value",
-					"sales_order": "sales_order",
-					"sales_order_value": "sales_order_value",
-					"wip_composite_asset": "wip_composite_asset",
-				},
-				"postprocess": update_value,
-				"condition": lambda doc: abs(doc.received_qty) < abs(doc.qty)
-				and doc.delivered_by_supplier != 1,
-			},
-			"Purchase Taxes and Charges": {"doctype": "Purchase Taxes and Charges", "add_if_empty": True},
-		},
+		PURCHASE_RECEIPT_MAPPING,
 		target_doc,
 		set_missing_value,
 	)
@@ -590,33 +1882,299 @@ def make_purchase_receipt(source_name, target_doc=None):
 	return doc
 
 
+def get_buying_cost_center_resolver():
+	"""Return a function resolving the default buying cost center of a row.
+
+	Each distinct project, (value, Amazon) and (value group, Amazon) is resolved once per
+	resolver. The lookups go through the document cache, which is cleared when the value,
+	value Group or Project is saved."""
+	project_cost_centers, value_cost_centers, value_group_cost_centers = {}, {}, {}
+
+	def get_cost_center(value_code, project, Amazon):
+		if project:
+			if project not in project_cost_centers:
+				project_cost_centers[project] = frappe.get_cached_value("Project", project, "cost_center")
+			if project_cost_centers[project]:
+				return project_cost_centers[project]
+
+		if (value_code, Amazon) not in value_cost_centers:
+			value_cost_centers[(value_code, Amazon)] = get_value_defaults(value_code, Amazon).get(
+				"buying_cost_center"
+			)
+		if value_cost_centers[(value_code, Amazon)]:
+			return value_cost_centers[(value_code, Amazon)]
+
+		value_group = frappe.get_cached_value("value", value_code, "value_group")
+		if (value_group, Amazon) not in value_group_cost_centers:
+			value_group_cost_centers[(value_group, Amazon)] = get_value_group_defaults(
+				value_code, Amazon
+			).get("buying_cost_center")
+		return value_group_cost_centers[(value_group, Amazon)]
+
+	return get_cost_center
+
+
+@frappe.whitelist()
+def make_purchase_receipts(purchase_orders):
+	"""Create draft Purchase Receipts for many purchase orderss at once.
+
+	Orders are consolidated into one receipt per supplier, Amazon, currency and tax template.
+	The status of each purchase orders is published as its receipt is created and returned."""
+	if isinstance(purchase_orders, str):
+		purchase_orders = json.loads(purchase_orders)
+
+	if not frappe.has_permission("Purchase Receipt", "create"):
+		frappe.throw(_("Not permitted"), frappe.PermissionError)
+
+	groups, results = get_purchase_orders_pending_receipt(purchase_orders)
+	for names in groups.values():
+		frappe.db.savepoint("bulk_purchase_receipt")
+		try:
+			doc = None
+			for name in names:
+				doc = get_mapped_doc("purchase orders", name, PURCHASE_RECEIPT_MAPPING, doc)
+			set_missing_value(None, doc)
+			doc.insert()
+			status = {"status": "Created", "purchase_receipt": doc.name}
+		except Exception as e:
+			frappe.db.rollback(save_point="bulk_purchase_receipt")
+			status = {"status": "Failed", "message": cstr(e)}
+
+		for name in names:
+			results[name].update(status)
+			frappe.publish_realtime(
+				"bulk_purchase_receipt_progress", results[name], user=frappe.session.user
+			)
+
+	frappe.local.message_log = []
+	return [results[name] for name in purchase_orders]
+
+
+def get_purchase_orders_pending_receipt(names):
+	po_value = frappe.qb.DocType("purchase orders value")
+	pending_rows = (
+		frappe.qb.from_(po_value)
+		.select(po_value.parent, Count("*"))
+		.where(
+			(po_value.parent.isin(names))
+			& (Abs(po_value.received_qty) < Abs(po_value.qty))
+			& (po_value.delivered_by_supplier != 1)
+		)
+		.groupby(po_value.parent)
+	)
+
+	return group_purchase_orders_for_mapping(
+		names, pending_rows, _("All value have already been received")
+	)
+
+
+def get_purchase_orders_pending_billing(names):
+	po_value = frappe.qb.DocType("purchase orders value")
+	pending_rows = (
+		frappe.qb.from_(po_value)
+		.select(po_value.parent, Sum(po_value.amount - po_value.billed_amt))
+		.where(
+			(po_value.parent.isin(names))
+			& ((po_value.base_amount == 0) | (Abs(po_value.billed_amt) < Abs(po_value.amount)))
+		)
+		.groupby(po_value.parent)
+	)
+
+	return group_purchase_orders_for_mapping(
+		names, pending_rows, _("All value have already been billed")
+	)
+
+
+def group_purchase_orders_for_mapping(names, pending_rows, nothing_pending_message):
+	"""Group purchase orderss that still have rows to map by supplier, Amazon, currency,
+	subcontracting and taxes. `pending_rows` is a query returning (purchase orders, pending) pairs.
+
+	Returns the groups and a status entry for every name, filled in with a reason when skipped."""
+	results = {
+		name: frappe._dict(purchase_order=name, status="Skipped", message=_("Not found"))
+		for name in names
+	}
+	if not names:
+		return {}, results
+
+	pending = frappe._dict(pending_rows.run())
+
+	tax_signatures = get_tax_signatures(names)
+
+	groups = {}
+	for po in frappe.get_all(
+		"purchase orders",
+		filters={"name": ("in", names)},
+		fields=[
+			"name",
+			"docstatus",
+			"status",
+			"supplier",
+			"Amazon",
+			"currency",
+			"taxes_and_charges",
+			"is_subcontracted",
+		],
+	):
+		if po.docstatus != 1 or po.status in ("Closed", "On Hold"):
+			results[po.name].message = _("purchase orders is not submitted or is {0}").format(
+				_(po.status)
+			)
+		elif po.name not in pending:
+			results[po.name].message = nothing_pending_message
+		else:
+			results[po.name].update(message=None, pending=flt(pending[po.name]))
+			key = (
+				po.supplier,
+				po.Amazon,
+				po.currency,
+				po.taxes_and_charges,
+				cint(po.is_subcontracted),
+				tax_signatures.get(po.name),
+			)
+			groups.setdefault(key, []).append(po.name)
+
+	# keep the order in which the purchase orderss were requested
+	position = {name: idx for idx, name in enumerate(names)}
+	for key in groups:
+		groups[key].sort(key=position.get)
+
+	return groups, results
+
+
+def get_tax_signatures(names):
+	"""Signature of the tax rows of each purchase orders, by name.
+
+	The mapped document keeps the taxes of the first purchase orders only, so orders are merged
+	only when their tax rows are the same. Taxes with a fixed amount are never merged, the amount
+	would be applied once for all of them."""
+	signatures = {}
+	for d in frappe.get_all(
+		"Purchase Taxes and Charges",
+		filters={"parenttype": "purchase orders", "parent": ("in", names)},
+		fields=[
+			"parent",
+			"charge_type",
+			"account_head",
+			"rate",
+			"add_deduct_tax",
+			"category",
+			"row_id",
+			"included_in_print_rate",
+		],
+		order_by="idx",
+	):
+		if d.charge_type == "Actual":
+			signatures[d.parent] = d.parent
+		elif signatures.get(d.parent) != d.parent:
+			row = (
+				d.charge_type,
+				d.account_head,
+				flt(d.rate),
+				d.add_deduct_tax,
+				d.category,
+				d.row_id,
+				cint(d.included_in_print_rate),
+			)
+			signatures[d.parent] = signatures.get(d.parent, ()) + (row,)
+
+	return signatures
+
+
 @frappe.whitelist()
 def make_purchase_invoice(source_name, target_doc=None):
 	return get_mapped_purchase_invoice(source_name, target_doc)
 
 
 @frappe.whitelist()
-def make_purchase_invoice_from_portal(purchase_order_name):
-	doc = get_mapped_purchase_invoice(purchase_order_name, ignore_permissions=True)
-	if doc.contact_email != frappe.session.user:
+def make_purchase_invoice_from_portal(purchase_order_name, run_async=1):
+	"""Create (once) the supplier's draft Purchase Invoice for a purchase orders.
+
+	Repeated calls by the same user reuse the existing draft and only the first of concurrent
+	calls creates it. With `run_async` the mapping runs in a background job and the supplier sees
+	a page saying the invoice is being created, from which they can open it once it exists."""
+	user = frappe.session.user
+	if frappe.db.get_value("purchase orders", purchase_order_name, "contact_email") != user:
 		frappe.throw(_("Not Permitted"), frappe.PermissionError)
-	doc.save()
-	frappe.db.commit()
-	frappe.response["type"] = "redirect"
-	frappe.response.location = "/purchase-invoices/" + doc.name
 
+	invoice = get_portal_purchase_invoice(purchase_order_name, user)
+	if not invoice and frappe.cache().set(
+		get_portal_invoice_lock_key(purchase_order_name, user),
+		1,
+		ex=PORTAL_INVOICE_LOCK_EXPIRY,
+		nx=True,
+	):
+		if cint(run_async):
+			frappe.enqueue(
+				create_portal_purchase_invoice,
+				queue="short",
+				purchase_order_name=purchase_order_name,
+				user=user,
+			)
+		else:
+			invoice = create_portal_purchase_invoice(purchase_order_name, user)
 
-def get_mapped_purchase_invoice(source_name, target_doc=None, ignore_permissions=False):
-	def postprocess(source, target):
-		target.flags.ignore_permissions = ignore_permissions
-		set_missing_value(source, target)
-		# Get the advance paid Journal Entries in Purchase Invoice Advance
-		if target.get("allocate_advances_automatically"):
-			target.set_advances()
+	if invoice:
+		frappe.response["type"] = "redirect"
+		frappe.response.location = "/purchase-invoices/" + invoice
+	else:
+		frappe.respond_as_web_page(
+			_("Creating Invoice"),
+			_("Your invoice for {0} is being created, it will open in a few moments.").format(
+				purchase_order_name
+			),
+			indicator_color="blue",
+			primary_action=(
+				"/api/method/erpnext.buying.doctype.purchase_order.purchase_order."
+				"make_purchase_invoice_from_portal?purchase_order_name=" + purchase_order_name
+			),
+			primary_label=_("Open Invoice"),
+		)
+
+
+def get_portal_invoice_lock_key(purchase_order_name, user):
+	return frappe.cache().make_key(f"portal_purchase_invoice:{purchase_order_name}:{user}")
+
+
+def get_portal_purchase_invoice(purchase_order_name, user):
+	"""Draft Purchase Invoice already created by `user` against the purchase orders"""
+	pi = frappe.qb.DocType("Purchase Invoice")
+	pi_value = frappe.qb.DocType("Purchase Invoice value")
+	invoice = (
+		frappe.qb.from_(pi)
+		.inner_join(pi_value)
+		.on(pi_value.parent == pi.name)
+		.select(pi.name)
+		.where(
+			(pi_value.purchase_order == purchase_order_name)
+			& (pi.docstatus == 0)
+			& (pi.owner == user)
+		)
+		.limit(1)
+	).run()
+
+	return invoice[0][0] if invoice else None
+
+
+def create_portal_purchase_invoice(purchase_order_name, user):
+	try:
+		if invoice := get_portal_purchase_invoice(purchase_order_name, user):
+			return invoice
+
+		doc = get_mapped_purchase_invoice(purchase_order_name, ignore_permissions=True)
+		if doc.contact_email != user:
+			frappe.throw(_("Not Permitted"), frappe.PermissionError)
+		doc.save()
+		if not frappe.flags.in_test:
+			frappe.db.commit()
+
+		return doc.name
+	finally:
+		# the draft is visible now, later calls find it instead of taking the lock
+		frappe.cache().delete(get_portal_invoice_lock_key(purchase_order_name, user))
 
-		target.set_payment_schedule()
-		target.credit_to = get_party_account("Supplier", source.supplier, source.Amazon)
 
+def get_purchase_invoice_mapping(get_cost_center):
 	def update_value(obj, target, source_parent):
 		target.amount = flt(obj.amount) - flt(obj.billed_amt)
 		target.base_amount = target.amount * flt(source_parent.conversion_rate)
@@ -624,16 +2182,11 @@ def get_mapped_purchase_invoice(source_name, target_doc=None, ignore_permissions
 			target.amount / flt(obj.rate) if (flt(obj.rate) and flt(obj.billed_amt)) else flt(obj.qty)
 		)
 
-		value = get_value_defaults(target.value_code, source_parent.Amazon)
-		value_group = get_value_group_defaults(target.value_code, source_parent.Amazon)
-		target.cost_center = (
-			obj.cost_center
-			or frappe.db.get_value("Project", obj.project, "cost_center")
-			or value.get("buying_cost_center")
-			or value_group.get("buying_cost_center")
+		target.cost_center = obj.cost_center or get_cost_center(
+			target.value_code, obj.project, source_parent.Amazon
 		)
 
-	fields = {
+	return {
 		"purchase orders": {
 			"doctype": "Purchase Invoice",
 			"field_map": {
@@ -658,10 +2211,22 @@ def get_mapped_purchase_invoice(source_name, target_doc=None, ignore_permissions
 		"Purchase Taxes and Charges": {"doctype": "Purchase Taxes and Charges", "add_if_empty": True},
 	}
 
+
+def get_mapped_purchase_invoice(source_name, target_doc=None, ignore_permissions=False):
+	def postprocess(source, target):
+		target.flags.ignore_permissions = ignore_permissions
+		set_missing_value(source, target)
+		# Get the advance paid Journal Entries in Purchase Invoice Advance
+		if target.get("allocate_advances_automatically"):
+			target.set_advances()
+
+		target.set_payment_schedule()
+		target.credit_to = get_party_account("Supplier", source.supplier, source.Amazon)
+
 	doc = get_mapped_doc(
 		"purchase orders",
 		source_name,
-		fields,
+		get_purchase_invoice_mapping(get_buying_cost_center_resolver()),
 		target_doc,
 		postprocess,
 		ignore_permissions=ignore_permissions,
@@ -671,6 +2236,300 @@ def get_mapped_purchase_invoice(source_name, target_doc=None, ignore_permissions
 	return doc
 
 
+@frappe.whitelist()
+def make_purchase_invoices(purchase_orders):
+	"""Queue consolidated draft Purchase Invoices for many purchase orderss, returns the job key"""
+	if isinstance(purchase_orders, str):
+		purchase_orders = json.loads(purchase_orders)
+
+	if not frappe.has_permission("Purchase Invoice", "create"):
+		frappe.throw(_("Not permitted"), frappe.PermissionError)
+
+	job_key = "bulk_purchase_invoice:" + frappe.generate_hash(length=10)
+	frappe.cache().set_value(
+		job_key,
+		{"purchase_orders": purchase_orders, "results": [], "completed": False},
+		expires_in_sec=BULK_STATUS_STATE_EXPIRY,
+	)
+
+	frappe.enqueue(
+		process_bulk_purchase_invoices,
+		queue="long",
+		timeout=3600,
+		job_key=job_key,
+		enqueue_after_commit=True,
+	)
+
+	return job_key
+
+
+@frappe.whitelist()
+def get_bulk_purchase_invoice_result(job_key):
+	return frappe.cache().get_value(job_key)
+
+
+def process_bulk_purchase_invoices(job_key):
+	"""Create one Purchase Invoice per supplier, Amazon, currency and taxes.
+
+	Party accounts and cost centers are resolved once for the whole job, payment schedule once per
+	invoice instead of once per purchase orders. Advances of a supplier are fetched once and shared
+	out between all its invoices. Results are saved with every invoice, so a restarted job skips
+	the purchase orders already handled."""
+	cache = frappe.cache()
+	state = cache.get_value(job_key)
+	if not state or state["completed"]:
+		return
+
+	purchase_orders = state["purchase_orders"]
+	handled = state.setdefault("handled", {})
+	advance_pools = state.setdefault("advance_pools", {})
+
+	groups, results = get_purchase_orders_pending_billing(
+		[name for name in purchase_orders if name not in handled]
+	)
+
+	supplier_orders = {}
+	for key, names in groups.items():
+		supplier_orders.setdefault(key[:2], []).extend(names)
+
+	mapping = get_purchase_invoice_mapping(get_buying_cost_center_resolver())
+	credit_to_accounts = {}
+
+	for idx, (key, names) in enumerate(groups.items(), 1):
+		supplier, Amazon = key[:2]
+		if (supplier, Amazon) not in credit_to_accounts:
+			credit_to_accounts[(supplier, Amazon)] = get_party_account("Supplier", supplier, Amazon)
+
+		allocations = {}
+		pool_key = f"{supplier}|{Amazon}"
+		frappe.db.savepoint("bulk_purchase_invoice")
+		try:
+			doc = None
+			for name in names:
+				doc = get_mapped_doc("purchase orders", name, mapping, doc)
+
+			set_missing_value(None, doc)
+			doc.credit_to = credit_to_accounts[(supplier, Amazon)]
+			if doc.get("allocate_advances_automatically"):
+				if pool_key not in advance_pools:
+					advance_pools[pool_key] = get_supplier_advance_pool(
+						doc, supplier_orders[(supplier, Amazon)]
+					)
+				allocations = allocate_supplier_advances(doc, advance_pools[pool_key], names)
+				# allocated above from the shared pool, validate must not allocate again
+				doc.allocate_advances_automatically = 0
+
+			doc.set_payment_schedule()
+			doc.insert()
+			status = {"status": "Created", "purchase_invoice": doc.name}
+		except Exception as e:
+			frappe.db.rollback(save_point="bulk_purchase_invoice")
+			allocations = {}
+			status = {"status": "Failed", "message": cstr(e)}
+
+		for reference, allocated_amount in allocations.items():
+			advance_pools[pool_key][reference]["remaining"] -= allocated_amount
+
+		for name in names:
+			results[name].update(status)
+			handled[name] = results[name]
+
+		if not frappe.flags.in_test:
+			frappe.db.commit()
+		cache.set_value(job_key, state, expires_in_sec=BULK_STATUS_STATE_EXPIRY)
+		frappe.publish_progress(
+			idx * 100 / len(groups),
+			title=_("Creating Purchase Invoices"),
+			description=_("{0} of {1}").format(idx, len(groups)),
+		)
+
+	frappe.local.message_log = []
+	state["results"] = [handled.get(name) or results[name] for name in purchase_orders]
+	state["completed"] = True
+	cache.set_value(job_key, state, expires_in_sec=BULK_STATUS_STATE_EXPIRY)
+
+
+def get_supplier_advance_pool(doc, order_list):
+	"""Advances of the invoice's supplier against any of `order_list` or unallocated, by reference.
+
+	Same entries `get_advance_entries` returns for one invoice, fetched for all the orders of the
+	supplier in the job."""
+	entries = get_advance_journal_entries(
+		"Supplier",
+		doc.supplier,
+		doc.credit_to,
+		"debit_in_account_currency",
+		"purchase orders",
+		order_list,
+		True,
+	) + get_advance_payment_entries(
+		"Supplier", doc.supplier, doc.credit_to, "purchase orders", order_list, True
+	)
+
+	pool = {}
+	for d in entries:
+		reference = f"{d.reference_type}|{d.reference_name}|{cstr(d.get('reference_row'))}"
+		pool[reference] = {
+			"reference_type": d.reference_type,
+			"reference_name": d.reference_name,
+			"reference_row": d.get("reference_row"),
+			"remarks": d.get("remarks"),
+			"advance_amount": flt(d.amount),
+			"exchange_rate": flt(d.get("exchange_rate")),
+			"against_order": d.get("against_order"),
+			"remaining": flt(d.amount),
+		}
+
+	return pool
+
+
+def allocate_supplier_advances(doc, pool, order_names):
+	"""`set_advances` drawing on advances shared by several invoices of the supplier.
+
+	Advances against the invoice's own orders come first, then unallocated ones, each up to what
+	earlier invoices left of it. Returns the amount taken from each advance."""
+	if doc.get("party_account_currency") == frappe.get_cached_value(
+		"Amazon", doc.Amazon, "default_currency"
+	):
+		invoice_amount = flt(doc.get("base_rounded_total") or doc.base_grand_total)
+	else:
+		invoice_amount = flt(doc.get("rounded_total") or doc.grand_total)
+
+	only_allocated = cint(doc.get("only_include_allocated_payments"))
+	candidates = [
+		(reference, d)
+		for reference, d in pool.items()
+		if (d["against_order"] in order_names) or (not d["against_order"] and not only_allocated)
+	]
+	candidates.sort(key=lambda c: not c[1]["against_order"])
+
+	doc.set("advances", [])
+	allocations = {}
+	for reference, d in candidates:
+		allocated_amount = min(invoice_amount - sum(allocations.values()), d["remaining"])
+		if allocated_amount <= 0:
+			continue
+
+		allocations[reference] = allocated_amount
+		doc.append(
+			"advances",
+			{
+				"doctype": "Purchase Invoice Advance",
+				"reference_type": d["reference_type"],
+				"reference_name": d["reference_name"],
+				"reference_row": d["reference_row"],
+				"remarks": d["remarks"],
+				"advance_amount": d["advance_amount"],
+				"allocated_amount": allocated_amount,
+				"ref_exchange_rate": d["exchange_rate"],
+			},
+		)
+
+	return allocations
+
+
+@frappe.whitelist()
+def insert_purchase_orders(purchase_orders, submit=0):
+	"""Queue the insertion of many purchase orders, returns the job key.
+
+	Each entry is the dict of a purchase orders with its value rows. Results are reported for every
+	entry, in the order they were passed."""
+	if isinstance(purchase_orders, str):
+		purchase_orders = json.loads(purchase_orders)
+
+	if not frappe.has_permission("purchase orders", "submit" if cint(submit) else "create"):
+		frappe.throw(_("Not permitted"), frappe.PermissionError)
+
+	job_key = "bulk_purchase_order_insert:" + frappe.generate_hash(length=10)
+	frappe.cache().set_value(
+		job_key,
+		{
+			"purchase_orders": purchase_orders,
+			"submit": cint(submit),
+			"results": [],
+			"completed": False,
+		},
+		expires_in_sec=BULK_STATUS_STATE_EXPIRY,
+	)
+
+	frappe.enqueue(
+		process_bulk_purchase_order_insert,
+		queue="long",
+		timeout=3600,
+		job_key=job_key,
+		enqueue_after_commit=True,
+	)
+
+	return job_key
+
+
+@frappe.whitelist()
+def get_bulk_purchase_order_insert_result(job_key):
+	return frappe.cache().get_value(job_key)
+
+
+def process_bulk_purchase_order_insert(job_key):
+	"""Insert the purchase orders of a queued job in batches, committing after each batch.
+
+	Progress is saved with every batch, so a restarted job continues after the last one."""
+	cache = frappe.cache()
+	state = cache.get_value(job_key)
+	if not state or state["completed"]:
+		return
+
+	purchase_orders = state["purchase_orders"]
+	for start in range(len(state["results"]), len(purchase_orders), BULK_INSERT_BATCH_SIZE):
+		batch = purchase_orders[start : start + BULK_INSERT_BATCH_SIZE]
+		state["results"].extend(insert_purchase_order_batch(batch, state["submit"], start))
+		if not frappe.flags.in_test:
+			frappe.db.commit()
+		cache.set_value(job_key, state, expires_in_sec=BULK_STATUS_STATE_EXPIRY)
+
+		frappe.publish_progress(
+			len(state["results"]) * 100 / len(purchase_orders),
+			title=_("Creating purchase orders"),
+			description=_("{0} of {1}").format(len(state["results"]), len(purchase_orders)),
+		)
+
+	state["completed"] = True
+	cache.set_value(job_key, state, expires_in_sec=BULK_STATUS_STATE_EXPIRY)
+
+
+def insert_purchase_order_batch(purchase_orders, submit=False, offset=0):
+	"""Insert, and submit if asked, `purchase_orders` validated against master data prefetched
+	once for the batch. A failing purchase orders is rolled back alone and reported with its
+	error, the others are still inserted."""
+	results = []
+	docs = []
+	for idx, data in enumerate(purchase_orders, offset):
+		result = frappe._dict(idx=idx, status="Failed", purchase_order=None, message=None)
+		results.append(result)
+		try:
+			doc = frappe.get_doc(dict(data, doctype="purchase orders"))
+			doc.set_missing_value()
+			# submitting on insert runs validate once instead of again on submit
+			doc.docstatus = 1 if cint(submit) else 0
+			docs.append((result, doc))
+		except Exception as e:
+			result.message = cstr(e)
+
+	prefetch_purchase_order_master_data([doc for result, doc in docs])
+	try:
+		for result, doc in docs:
+			frappe.db.savepoint("bulk_purchase_order_insert")
+			try:
+				doc.insert()
+				result.update(status="Submitted" if doc.docstatus == 1 else "Created", purchase_order=doc.name)
+			except Exception as e:
+				frappe.db.rollback(save_point="bulk_purchase_order_insert")
+				result.message = cstr(e)
+	finally:
+		frappe.local.purchase_order_master_data = None
+
+	frappe.local.message_log = []
+	return results
+
+
 def get_list_context(context=None):
 	from erpnext.controllers.website_list_for_contact import get_list_context
 
@@ -681,11 +2540,117 @@ def get_list_context(context=None):
 			"show_search": True,
 			"no_breadcrumbs": True,
 			"title": _("purchase orderss"),
+			"get_list": get_portal_purchase_orders,
 		}
 	)
 	return list_context
 
 
+def get_portal_purchase_orders(
+	doctype, txt=None, filters=None, limit_start=0, limit_page_length=20, order_by=None
+):
+	"""Portal list of the supplier's purchase orderss, newest first.
+
+	Pages are read by keyset on (transaction_date, name): the last row of every page is cached
+	as the cursor of the next one, offsets are only used when no cursor is known. The web list
+	asks for one row more than it shows to know if there is a next page, so the last shown row
+	is the one before the extra row. Search is a prefix match on name so it can use the primary
+	key."""
+	from erpnext.controllers.website_list_for_contact import (
+		get_customers_suppliers,
+		get_transaction_list,
+		is_website_user,
+	)
+
+	user = frappe.session.user
+	if user == "Guest" or not is_website_user() or filters:
+		return get_transaction_list(doctype, txt, filters, limit_start, limit_page_length)
+
+	customers, suppliers = get_customers_suppliers(doctype, user)
+	if not suppliers:
+		return []
+
+	po = frappe.qb.DocType("purchase orders")
+	query = (
+		frappe.qb.from_(po)
+		.select(
+			po.name,
+			po.transaction_date,
+			po.supplier_name,
+			po.status,
+			po.per_received,
+			po.per_billed,
+			po.currency,
+			po.grand_total,
+			po.modified,
+		)
+		.where((po.supplier.isin(suppliers)) & (po.docstatus == 1))
+		.orderby(po.transaction_date, order=Order.desc)
+		.orderby(po.name, order=Order.desc)
+		.limit(cint(limit_page_length))
+	)
+
+	if txt:
+		txt = txt.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+		query = query.where(po.name.like(txt + "%"))
+
+	cursor_key = "portal_purchase_order_cursor:{0}:{1}".format(user, txt or "")
+	cursor = frappe.cache().get_value(f"{cursor_key}:{cint(limit_start)}") if limit_start else None
+	if cursor:
+		transaction_date, name = cursor
+		query = query.where(
+			(po.transaction_date < transaction_date)
+			| ((po.transaction_date == transaction_date) & (po.name < name))
+		)
+	elif limit_start:
+		query = query.offset(cint(limit_start))
+
+	orders = query.run(as_dict=True)
+	page_length = cint(limit_page_length) - 1
+	if page_length > 0 and len(orders) > page_length:
+		last_shown = orders[page_length - 1]
+		frappe.cache().set_value(
+			f"{cursor_key}:{cint(limit_start) + page_length}",
+			(last_shown.transaction_date, last_shown.name),
+			expires_in_sec=PORTAL_CURSOR_CACHE_EXPIRY,
+		)
+
+	return set_portal_list_details(orders)
+
+
+def set_portal_list_details(orders):
+	"""Add what the portal row shows to the listed orders with one query on their value.
+
+	Rows are returned as documents built from the selected fields, the row template formats
+	them with `get_formatted`."""
+	value_names = {}
+	if orders:
+		for d in frappe.get_all(
+			"purchase orders value",
+			filters={"parent": ("in", [d.name for d in orders])},
+			fields=["parent", "value_name"],
+			order_by="idx",
+		):
+			if d.value_name:
+				value_names.setdefault(d.parent, []).append(d.value_name)
+
+	for d in orders:
+		d.doctype = "purchase orders"
+		d.status_percent = flt(d.per_billed)
+		d.status_display = ""
+		if d.per_billed:
+			d.status_display = (
+				_("Billed") if d.per_billed == 100 else _("{0}% Billed").format(d.per_billed)
+			)
+		d.value_preview = ", ".join(value_names.get(d.name, []))
+
+	return [frappe.get_doc(d) for d in orders]
+
+
+def on_doctype_update():
+	frappe.db.add_index("purchase orders", ["supplier", "docstatus", "transaction_date", "name"])
+
+
 @frappe.whitelist()
 def update_status(status, name):
 	po = frappe.get_doc("purchase orders", name)
@@ -1,4 +1,6 @@
+import frappe
 from frappe import _
+from frappe.desk.reportview import get_match_cond
 
 
 def get_data():
@@ -26,3 +28,138 @@ def get_data():
 			{"label": _("Internal"), "value": ["sales orders"]},
 		],
 	}
+
+
+LINK_COUNTS_CACHE_EXPIRY = 60 * 60
+
+
+@frappe.whitelist()
+def get_link_counts(name, doctype=None, items=None):
+	"""Counts for the connections dashboard, same shape as `frappe.desk.notifications.get_open_count`.
+
+	Every external link is counted in one union query and internal links come from one query
+	on the value table. Cancelled documents and documents the user cannot read are not counted.
+	The result is cached per purchase orders and user until a linked document is saved,
+	submitted, cancelled or deleted.
+
+	Only set it as the dashboard `method` together with the `clear_link_counts` doc_events,
+	without them the cached counts go stale."""
+	frappe.has_permission("purchase orders", doc=name, throw=True)
+
+	cache = frappe.cache()
+	cache_key = get_link_counts_cache_key(name)
+	counts = cache.hget(cache_key, frappe.session.user)
+	if counts is None:
+		counts = {
+			"external_links_found": get_external_link_counts(name),
+			"internal_links_found": get_internal_links(name),
+		}
+		cache.hset(cache_key, frappe.session.user, counts)
+		cache.expire(cache.make_key(cache_key), LINK_COUNTS_CACHE_EXPIRY)
+
+	return {"count": counts}
+
+
+def get_external_link_counts(name):
+	data = get_data()
+	linked_doctypes = [
+		d
+		for group in data["transactions"]
+		for d in group["value"]
+		if d not in data["internal_links"]
+	]
+
+	queries, values = [], {"name": name}
+	for idx, doctype in enumerate(linked_doctypes):
+		fieldname = data["non_standard_fieldnames"].get(doctype, data["fieldname"])
+		if not frappe.has_permission(doctype):
+			continue
+
+		meta = frappe.get_meta(doctype)
+		values[f"doctype_{idx}"] = doctype
+		# user permissions and permission query conditions, as frappe.get_all would apply
+		match_cond = get_match_cond(doctype)
+
+		if meta.has_field(fieldname):
+			queries.append(
+				f"""select %(doctype_{idx})s, count(*) from `tab{doctype}`
+				where `tab{doctype}`.`{fieldname}` = %(name)s and `tab{doctype}`.docstatus < 2
+				{match_cond}"""
+			)
+			continue
+
+		# link kept on a child row, count the distinct parents
+		for df in meta.get_table_fields():
+			if not frappe.get_meta(df.options).has_field(fieldname):
+				continue
+
+			queries.append(
+				f"""select %(doctype_{idx})s, count(distinct `tab{doctype}`.name)
+				from `tab{df.options}`
+				inner join `tab{doctype}` on `tab{doctype}`.name = `tab{df.options}`.parent
+				where `tab{df.options}`.`{fieldname}` = %(name)s
+				and `tab{df.options}`.parenttype = %(doctype_{idx})s
+				and `tab{doctype}`.docstatus < 2 {match_cond}"""
+			)
+
+	counts = {}
+	if queries:
+		for doctype, count in frappe.db.sql(" union all ".join(queries), values):
+			counts[doctype] = counts.get(doctype, 0) + count
+
+	return [{"name": d, "count": counts.get(d, 0), "open_count": 0} for d in linked_doctypes]
+
+
+def get_internal_links(name):
+	data = get_data()
+	meta = frappe.get_meta("purchase orders")
+
+	internal_links = []
+	for table_fieldname in {table for table, fieldname in data["internal_links"].values()}:
+		links = {
+			doctype: fieldname
+			for doctype, (table, fieldname) in data["internal_links"].items()
+			if table == table_fieldname
+		}
+		rows = frappe.get_all(
+			meta.get_field(table_fieldname).options,
+			filters={"parent": name, "parenttype": "purchase orders"},
+			fields=list(set(links.values())),
+			distinct=True,
+		)
+
+		for doctype, fieldname in links.items():
+			names = sorted({d[fieldname] for d in rows if d[fieldname]})
+			if names:
+				internal_links.append({"doctype": doctype, "names": names, "count": len(names)})
+
+	return internal_links
+
+
+def clear_link_counts(doc, method=None):
+	"""Drop cached dashboard counts of every purchase orders `doc` links to, or linked to before
+	this save.
+
+	Hooked to on_update, on_submit, on_cancel and on_trash of the doctypes listed in `get_data`."""
+	fieldnames = set(get_data()["non_standard_fieldnames"].values()) | {"purchase_order"}
+
+	docs = [doc]
+	if doc.get_doc_before_save():
+		docs.append(doc.get_doc_before_save())
+
+	purchase_orders = set()
+	for row in [row for d in docs for row in [d, *d.get_all_children()]]:
+		# Journal Entry Account keeps the linked doctype in reference_type
+		reference_doctype = row.get("reference_doctype") or row.get("reference_type")
+		for fieldname in fieldnames:
+			if row.get(fieldname) and (
+				fieldname == "purchase_order" or reference_doctype == "purchase orders"
+			):
+				purchase_orders.add(row.get(fieldname))
+
+	for name in purchase_orders:
+		frappe.cache().delete_value(get_link_counts_cache_key(name))
+
+
+def get_link_counts_cache_key(name):
+	return f"purchase_order_link_counts:{name}"
@@ -1052,6 +1052,573 @@ class TestPurchaseOrder(FrappeTestCase):
 		self.assertEqual(po.value[0].qty, 30)
 		self.assertEqual(po.value[0].fg_value_qty, 30)
 
+	def test_supplier_snapshot_single_query(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import get_request_metrics
+
+		po = create_purchase_order(do_not_save=True)
+		existing_queries = get_request_metrics().get("supplier_snapshot_queries", 0)
+
+		po.insert()
+		self.assertEqual(get_request_metrics().supplier_snapshot_queries, existing_queries + 1)
+		self.assertTrue(po.party_account_currency)
+
+	def test_bulk_close_and_reopen_purchase_orders(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			enqueue_bulk_status_update,
+			process_bulk_status_update,
+		)
+
+		existing_ordered_qty = get_ordered_qty()
+		names = [create_purchase_order(qty=1).name for i in range(3)]
+		self.assertEqual(get_ordered_qty(), existing_ordered_qty + 3)
+
+		process_bulk_status_update(enqueue_bulk_status_update(names, "Closed"))
+		for name in names:
+			self.assertEqual(frappe.db.get_value("purchase orders", name, "status"), "Closed")
+			self.assertTrue(
+				frappe.db.exists(
+					"Comment",
+					{
+						"comment_type": "Label",
+						"reference_doctype": "purchase orders",
+						"reference_name": name,
+						"content": "Closed",
+					},
+				)
+			)
+		self.assertEqual(get_ordered_qty(), existing_ordered_qty)
+
+		process_bulk_status_update(enqueue_bulk_status_update(names, "Submitted"))
+		for name in names:
+			self.assertEqual(
+				frappe.db.get_value("purchase orders", name, "status"), "To Receive and Bill"
+			)
+		self.assertEqual(get_ordered_qty(), existing_ordered_qty + 3)
+
+	def test_get_last_purchase_rate_for_all_rows(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import value_last_purchase_rate
+
+		create_purchase_order(value_code="_Test value", rate=321)
+
+		po = create_purchase_order(value_code="_Test value", rate=100, do_not_save=True)
+		po.append("value", dict(po.value[0].as_dict(), name=None, idx=None, conversion_factor=2))
+		po.get_last_purchase_rate()
+
+		self.assertEqual(po.value[0].rate, 321)
+		self.assertEqual(po.value[1].rate, 642)
+		self.assertEqual(value_last_purchase_rate(None, 1, "_Test value"), 321)
+
+	def test_incremental_ordered_qty(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import verify_bin_ordered_qty
+
+		verify_bin_ordered_qty("_Test value", "_Test house - _TC", repair=True)
+		existing_ordered_qty = get_ordered_qty()
+
+		frappe.conf.incremental_bin_ordered_qty = 1
+		try:
+			po = create_purchase_order(qty=5)
+			self.assertEqual(get_ordered_qty(), existing_ordered_qty + 5)
+
+			po.update_status("Closed")
+			self.assertEqual(get_ordered_qty(), existing_ordered_qty)
+
+			po.update_status("Draft")
+			self.assertEqual(get_ordered_qty(), existing_ordered_qty + 5)
+
+			po.cancel()
+			self.assertEqual(get_ordered_qty(), existing_ordered_qty)
+		finally:
+			frappe.conf.incremental_bin_ordered_qty = 0
+
+		self.assertFalse(verify_bin_ordered_qty("_Test value", "_Test house - _TC"))
+
+	def test_requested_qty_for_po_against_multiple_mr(self):
+		mr_1 = make_material_request(qty=5)
+		mr_2 = make_material_request(qty=3)
+		existing_requested_qty = get_requested_qty()
+
+		po = make_purchase_order(mr_1.name)
+		po.supplier = "_Test Supplier"
+		po.extend("value", make_purchase_order(mr_2.name).get("value"))
+		po.save()
+		po.submit()
+		self.assertEqual(get_requested_qty(), existing_requested_qty - 8)
+
+		po.cancel()
+		self.assertEqual(get_requested_qty(), existing_requested_qty)
+
+	def test_update_status_of_stale_purchase_order(self):
+		po = create_purchase_order()
+		stale_po = frappe.get_doc("purchase orders", po.name)
+
+		po.update_status("Closed")
+		self.assertRaises(frappe.TimestampMismatchError, stale_po.update_status, "Draft")
+		self.assertEqual(frappe.db.get_value("purchase orders", po.name, "status"), "Closed")
+
+	def test_make_purchase_receipts_for_multiple_orders(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import make_purchase_receipts
+
+		po_1 = create_purchase_order(qty=2)
+		po_2 = create_purchase_order(qty=3)
+		po_3 = create_purchase_order(do_not_submit=True)
+
+		result = make_purchase_receipts([po_1.name, po_2.name, po_3.name])
+
+		self.assertEqual([d.status for d in result], ["Created", "Created", "Skipped"])
+		self.assertEqual(result[0].purchase_receipt, result[1].purchase_receipt)
+
+		pr = frappe.get_doc("Purchase Receipt", result[0].purchase_receipt)
+		self.assertEqual([d.purchase_order for d in pr.value], [po_1.name, po_2.name])
+		self.assertEqual([d.qty for d in pr.value], [2, 3])
+
+	def test_bulk_purchase_invoices_for_multiple_orders(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			get_bulk_purchase_invoice_result,
+			make_purchase_invoices,
+			process_bulk_purchase_invoices,
+		)
+
+		po_1 = create_purchase_order(qty=2, rate=100)
+		po_2 = create_purchase_order(qty=3, rate=100)
+
+		job_key = make_purchase_invoices([po_1.name, po_2.name])
+		process_bulk_purchase_invoices(job_key)
+		result = get_bulk_purchase_invoice_result(job_key)["results"]
+
+		self.assertEqual([d.status for d in result], ["Created", "Created"])
+		self.assertEqual([d.pending for d in result], [200, 300])
+
+		pi = frappe.get_doc("Purchase Invoice", result[0].purchase_invoice)
+		self.assertEqual(pi.name, result[1].purchase_invoice)
+		self.assertEqual(pi.total, 500)
+		self.assertTrue(pi.credit_to)
+
+	def test_minimum_order_qty_across_rows(self):
+		frappe.db.set_value("value", "_Test value", "min_order_qty", 15)
+		frappe.clear_document_cache("value", "_Test value")
+		try:
+			po = create_purchase_order(qty=10, do_not_save=True)
+			self.assertRaises(frappe.ValidationError, po.insert)
+
+			po.append("value", dict(po.value[0].as_dict(), name=None, idx=None, qty=5))
+			po.insert()
+		finally:
+			frappe.db.set_value("value", "_Test value", "min_order_qty", 0)
+			frappe.clear_document_cache("value", "_Test value")
+
+	def test_reference_mismatches_reported_together(self):
+		mr = make_material_request(qty=10)
+		po = make_purchase_order(mr.name)
+		po.supplier = "_Test Supplier"
+		po.append("value", dict(po.value[0].as_dict(), name=None, idx=None))
+		po.value[0].value_code = "_Test value 2"
+		po.value[1].value_code = "_Test value 2"
+
+		with self.assertRaises(frappe.ValidationError) as err:
+			po.save()
+
+		self.assertIn("row 1", str(err.exception))
+		self.assertIn("row 2", str(err.exception))
+
+	def test_per_ordered_for_multiple_material_requests(self):
+		mr_1 = make_material_request(qty=10)
+		mr_2 = make_material_request(qty=4)
+
+		po = make_purchase_order(mr_1.name)
+		po.supplier = "_Test Supplier"
+		po.value[0].qty = 5
+		po.extend("value", make_purchase_order(mr_2.name).get("value"))
+		po.save()
+		po.submit()
+
+		self.assertEqual(frappe.db.get_value("Material Request", mr_1.name, "per_ordered"), 50)
+		self.assertEqual(frappe.db.get_value("Material Request", mr_2.name, "per_ordered"), 100)
+		self.assertEqual(
+			frappe.db.get_value("Material Request value", mr_1.value[0].name, "ordered_qty"), 5
+		)
+
+		po.cancel()
+		self.assertEqual(frappe.db.get_value("Material Request", mr_1.name, "per_ordered"), 0)
+		self.assertEqual(frappe.db.get_value("Material Request", mr_2.name, "per_ordered"), 0)
+
+	def test_post_submit_pipeline_is_retry_safe(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			check_post_submit_consistency,
+			run_post_submit_pipeline,
+		)
+
+		po = create_purchase_order()
+		check_post_submit_consistency([po.name], repair=True)
+		existing_ordered_qty = get_ordered_qty()
+
+		# a retried pipeline recomputes instead of applying the submit twice
+		run_post_submit_pipeline(po.name)
+		run_post_submit_pipeline(po.name)
+		self.assertEqual(get_ordered_qty(), existing_ordered_qty)
+		self.assertFalse(check_post_submit_consistency([po.name]))
+
+		frappe.db.set_value(
+			"Bin",
+			{"value_code": "_Test value", "house": "_Test house - _TC"},
+			"ordered_qty",
+			existing_ordered_qty + 99,
+		)
+		mismatches = check_post_submit_consistency([po.name], repair=True)
+		self.assertEqual([d.field for d in mismatches], ["ordered_qty"])
+		self.assertEqual(get_ordered_qty(), existing_ordered_qty)
+
+	def test_insert_purchase_order_batch(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			get_request_metrics,
+			insert_purchase_order_batch,
+		)
+
+		valid = create_purchase_order(do_not_save=True).as_dict()
+		invalid = create_purchase_order(do_not_save=True).as_dict()
+		invalid["value"][0]["value_code"] = "_Test value that does not exist"
+
+		existing_queries = get_request_metrics().get("supplier_snapshot_queries", 0)
+		results = insert_purchase_order_batch([valid, invalid, valid], submit=True)
+
+		# one supplier snapshot query for the whole batch
+		self.assertEqual(get_request_metrics().supplier_snapshot_queries, existing_queries + 1)
+		self.assertEqual([d.status for d in results], ["Submitted", "Failed", "Submitted"])
+		self.assertTrue(results[1].message)
+		self.assertEqual(
+			frappe.db.get_value("purchase orders", results[0].purchase_order, "docstatus"), 1
+		)
+
+	def test_drop_ship_sales_order_refresh_waits_for_commit(self):
+		from unittest.mock import patch
+
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			DROP_SHIP_SO_REFRESH_QUEUE,
+			queue_drop_ship_sales_order_refresh,
+			refresh_queued_drop_ship_sales_orders,
+		)
+
+		def queued():
+			return {frappe.safe_decode(d) for d in frappe.cache().smembers(DROP_SHIP_SO_REFRESH_QUEUE)}
+
+		so_name = "_Test Drop Ship sales orders"
+		frappe.flags.in_test = False
+		try:
+			with patch("frappe.enqueue") as enqueue:
+				queue_drop_ship_sales_order_refresh([so_name])
+				queue_drop_ship_sales_order_refresh([so_name])
+				# not visible to other jobs while the purchase orders is uncommitted
+				self.assertNotIn(so_name, queued())
+
+				frappe.db.after_commit.run()
+				self.assertIn(so_name, queued())
+				enqueue.assert_called_once_with(refresh_queued_drop_ship_sales_orders, queue="short")
+
+				# a rolled back purchase orders queues nothing
+				enqueue.reset_mock()
+				frappe.cache().srem(DROP_SHIP_SO_REFRESH_QUEUE, so_name)
+				queue_drop_ship_sales_order_refresh([so_name])
+				frappe.db.after_rollback.run()
+				frappe.db.after_commit.run()
+				self.assertNotIn(so_name, queued())
+				enqueue.assert_not_called()
+		finally:
+			frappe.flags.in_test = True
+			frappe.flags.drop_ship_so_refresh_pending = None
+			frappe.cache().srem(DROP_SHIP_SO_REFRESH_QUEUE, so_name)
+
+	def test_cancel_before_post_submit_pipeline_with_incremental_ordered_qty(self):
+		from unittest.mock import patch
+
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			check_post_submit_consistency,
+			verify_bin_ordered_qty,
+		)
+
+		module = "erpnext.buying.doctype.purchase_order.purchase_order"
+		verify_bin_ordered_qty("_Test value", "_Test house - _TC", repair=True)
+		existing_ordered_qty = get_ordered_qty()
+
+		frappe.conf.incremental_bin_ordered_qty = 1
+		try:
+			with patch(f"{module}.is_post_submit_pipeline_enabled", return_value=True), patch(
+				f"{module}.enqueue_post_submit_updates"
+			) as enqueue:
+				po = create_purchase_order(qty=5)
+				enqueue.assert_called_once_with(po.name)
+				# the job has not run yet
+				self.assertEqual(get_ordered_qty(), existing_ordered_qty)
+
+				po.cancel()
+				self.assertEqual(get_ordered_qty(), existing_ordered_qty)
+		finally:
+			frappe.conf.incremental_bin_ordered_qty = 0
+
+		self.assertFalse(check_post_submit_consistency([po.name]))
+
+	def test_make_purchase_receipts_keeps_orders_with_different_taxes_apart(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import make_purchase_receipts
+
+		po_1 = create_purchase_order(qty=2)
+		po_2 = create_purchase_order(qty=3, do_not_save=True)
+		po_2.append(
+			"taxes",
+			{
+				"charge_type": "On Net Total",
+				"account_head": "_Test Account Service Tax - _TC",
+				"cost_center": "_Test Cost Center - _TC",
+				"description": "Service Tax",
+				"rate": 10,
+			},
+		)
+		po_2.insert()
+		po_2.submit()
+
+		result = make_purchase_receipts([po_1.name, po_2.name])
+
+		self.assertEqual([d.status for d in result], ["Created", "Created"])
+		self.assertNotEqual(result[0].purchase_receipt, result[1].purchase_receipt)
+		pr = frappe.get_doc("Purchase Receipt", result[1].purchase_receipt)
+		self.assertEqual([d.rate for d in pr.taxes], [10])
+
+	def test_bulk_purchase_invoices_resume_skips_handled_orders(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			get_bulk_purchase_invoice_result,
+			make_purchase_invoices,
+			process_bulk_purchase_invoices,
+		)
+
+		po_1 = create_purchase_order(qty=2, rate=100)
+		po_2 = create_purchase_order(qty=3, rate=100, do_not_save=True)
+		po_2.append(
+			"taxes",
+			{
+				"charge_type": "On Net Total",
+				"account_head": "_Test Account Service Tax - _TC",
+				"cost_center": "_Test Cost Center - _TC",
+				"description": "Service Tax",
+				"rate": 10,
+			},
+		)
+		po_2.insert()
+		po_2.submit()
+
+		job_key = make_purchase_invoices([po_1.name, po_2.name])
+		process_bulk_purchase_invoices(job_key)
+		result = get_bulk_purchase_invoice_result(job_key)
+		invoices = [d.purchase_invoice for d in result["results"]]
+		self.assertNotEqual(invoices[0], invoices[1])
+
+		# a rerun of the job, e.g. after a crash, creates no new invoice
+		result["completed"] = False
+		frappe.cache().set_value(job_key, result)
+		process_bulk_purchase_invoices(job_key)
+		self.assertEqual(get_bulk_purchase_invoice_result(job_key)["results"], result["results"])
+		self.assertEqual(
+			frappe.db.count("Purchase Invoice value", {"purchase_order": ("in", [po_1.name, po_2.name])}),
+			2,
+		)
+
+	def test_dashboard_link_counts(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order_dashboard import (
+			clear_link_counts,
+			get_link_counts,
+			get_link_counts_cache_key,
+		)
+
+		def count(doctype):
+			links = get_link_counts(po.name)["count"]["external_links_found"]
+			return next(d["count"] for d in links if d["name"] == doctype)
+
+		po = create_purchase_order()
+		self.assertEqual(count("Purchase Receipt"), 0)
+
+		# drafts count too, once their save hook clears the cached counts
+		pr = make_purchase_receipt(po.name)
+		pr.insert()
+		clear_link_counts(pr)
+		self.assertEqual(count("Purchase Receipt"), 1)
+
+		pr.submit()
+		pr.cancel()
+		clear_link_counts(pr)
+		self.assertEqual(count("Purchase Receipt"), 0)
+
+		# journal entries keep the link type in reference_type
+		get_link_counts(po.name)
+		je = frappe.get_doc(
+			{
+				"doctype": "Journal Entry",
+				"accounts": [{"reference_type": "purchase orders", "vasavierp": po.name}],
+			}
+		)
+		clear_link_counts(je)
+		self.assertIsNone(frappe.cache().hget(get_link_counts_cache_key(po.name), frappe.session.user))
+
+	def test_resume_bulk_status_update_while_running(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			enqueue_bulk_status_update,
+			get_bulk_status_update_lock_key,
+			process_bulk_status_update,
+			resume_bulk_status_update,
+		)
+
+		name = create_purchase_order(qty=1).name
+		job_key = enqueue_bulk_status_update([name], "Closed")
+		lock_key = get_bulk_status_update_lock_key(job_key)
+
+		frappe.cache().set(lock_key, 1)
+		try:
+			self.assertRaises(frappe.ValidationError, resume_bulk_status_update, job_key)
+			# a second copy of the job leaves the running one alone
+			process_bulk_status_update(job_key)
+			self.assertNotEqual(frappe.db.get_value("purchase orders", name, "status"), "Closed")
+		finally:
+			frappe.cache().delete(lock_key)
+
+		process_bulk_status_update(job_key)
+		self.assertEqual(frappe.db.get_value("purchase orders", name, "status"), "Closed")
+		self.assertIsNone(frappe.cache().get(lock_key))
+
+	def test_portal_purchase_invoice_reuses_draft(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import (
+			get_portal_invoice_lock_key,
+			make_purchase_invoice_from_portal,
+		)
+
+		po = create_purchase_order()
+		po.db_set("contact_email", frappe.session.user)
+		lock_key = get_portal_invoice_lock_key(po.name, frappe.session.user)
+
+		# another click is creating the invoice, nothing is created and a message is shown
+		frappe.cache().set(lock_key, 1)
+		try:
+			make_purchase_invoice_from_portal(po.name, run_async=0)
+			self.assertEqual(frappe.response["type"], "page")
+			self.assertFalse(frappe.db.exists("Purchase Invoice value", {"purchase_order": po.name}))
+		finally:
+			frappe.cache().delete(lock_key)
+
+		make_purchase_invoice_from_portal(po.name, run_async=0)
+		self.assertEqual(frappe.response["type"], "redirect")
+		invoice = frappe.response.location.split("/")[-1]
+		self.assertIsNone(frappe.cache().get(lock_key))
+
+		# the draft is reused by a later click
+		make_purchase_invoice_from_portal(po.name, run_async=0)
+		self.assertEqual(frappe.response.location, "/purchase-invoices/" + invoice)
+		self.assertEqual(
+			frappe.db.count("Purchase Invoice value", {"purchase_order": po.name}), len(po.value)
+		)
+
+	def test_portal_purchase_orders_pagination(self):
+		from unittest.mock import patch
+
+		from erpnext.buying.doctype.purchase_order.purchase_order import get_portal_purchase_orders
+
+		module = "erpnext.controllers.website_list_for_contact"
+		po = create_purchase_order()
+		for i in range(4):
+			create_purchase_order()
+
+		def get_page(txt=None, limit_start=0, limit=2):
+			# the web list asks for one row more than it shows, to know if there is a next page
+			rows = get_portal_purchase_orders(
+				"purchase orders", txt=txt, limit_start=limit_start, limit_page_length=limit + 1
+			)
+			return rows[:limit]
+
+		with patch(f"{module}.is_website_user", return_value=True), patch(
+			f"{module}.get_customers_suppliers", return_value=([], [po.supplier])
+		):
+			first_four = [d.name for d in get_page(limit=4)]
+			self.assertEqual(len(first_four), 4)
+
+			page_1 = get_page()
+			self.assertEqual([d.name for d in page_1], first_four[:2])
+			self.assertTrue(page_1[0].get_formatted("grand_total"))
+
+			# page 2 from the cursor of the last row shown on page 1
+			cursor_key = f"portal_purchase_order_cursor:{frappe.session.user}:"
+			self.assertEqual(frappe.cache().get_value(f"{cursor_key}:2")[1], first_four[1])
+			self.assertEqual([d.name for d in get_page(limit_start=2)], first_four[2:])
+
+			# page 2 by offset, when no cursor is known
+			frappe.cache().delete_value(f"{cursor_key}:2")
+			self.assertEqual([d.name for d in get_page(limit_start=2)], first_four[2:])
+
+			# wildcards in the search are matched literally
+			self.assertEqual(get_page(txt="%"), [])
+			self.assertEqual(get_page(txt="_"), [])
+			self.assertIn(po.name, [d.name for d in get_page(txt=po.name, limit=20)])
+
+	def test_post_submit_pipeline_rejects_stopped_material_request(self):
+		from unittest.mock import patch
+
+		module = "erpnext.buying.doctype.purchase_order.purchase_order"
+		mr = make_material_request(qty=5)
+		po = make_purchase_order(mr.name)
+		po.supplier = "_Test Supplier"
+		po.insert()
+		mr.db_set("status", "Stopped")
+
+		with patch(f"{module}.is_post_submit_pipeline_enabled", return_value=True), patch(
+			f"{module}.enqueue_post_submit_updates"
+		) as enqueue:
+			self.assertRaises(frappe.InvalidStatusError, po.submit)
+			enqueue.assert_not_called()
+
+	def test_supplier_advances_shared_between_bulk_invoices(self):
+		from erpnext.buying.doctype.purchase_order.purchase_order import allocate_supplier_advances
+
+		def advance(name, amount, against_order=None):
+			return {
+				"reference_type": "Payment Entry",
+				"reference_name": name,
+				"reference_row": None,
+				"remarks": None,
+				"advance_amount": amount,
+				"exchange_rate": 1,
+				"against_order": against_order,
+				"remaining": amount,
+			}
+
+		po = create_purchase_order(qty=2, rate=100)
+		pool = {
+			"linked": advance("PE-1", 150, po.name),
+			"other order": advance("PE-2", 50, "_Test Other purchase orders"),
+			"unallocated": advance("PE-3", 100),
+		}
+
+		pi = make_pi_from_po(po.name)
+		allocations = allocate_supplier_advances(pi, pool, [po.name])
+		# own order first, then unallocated, never advances of other orders
+		self.assertEqual(allocations, {"linked": 150, "unallocated": 50})
+		self.assertEqual([d.reference_name for d in pi.advances], ["PE-1", "PE-3"])
+
+		# a later invoice only gets what is left
+		for reference, amount in allocations.items():
+			pool[reference]["remaining"] -= amount
+		pi = make_pi_from_po(po.name)
+		self.assertEqual(allocate_supplier_advances(pi, pool, [po.name]), {"unallocated": 50})
+
+	def test_supplier_snapshot_database_round_trips(self):
+		from unittest.mock import patch
+
+		from erpnext.accounts.party import get_party_account_currency
+		from erpnext.buying.doctype.purchase_order.purchase_order import get_supplier_snapshot
+
+		get_supplier_snapshot("_Test Supplier", "_Test Amazon")
+
+		# the party account currency is cached for the request, only the snapshot query runs
+		with patch.object(frappe.db, "sql", wraps=frappe.db.sql) as sql:
+			snapshot = get_supplier_snapshot("_Test Supplier", "_Test Amazon")
+
+		self.assertEqual(sql.call_count, 1)
+		self.assertEqual(
+			snapshot.party_account_currency,
+			get_party_account_currency("Supplier", "_Test Supplier", "_Test Amazon"),
+		)
+
 
 def prepare_data_for_internal_transfer():
 	from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_internal_supplier